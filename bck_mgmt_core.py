@@ -0,0 +1,2794 @@
+# bck_mgmt: all functions of the script. bck_mgmt.py only calls cli(), so this module is compiled once and its bytecode
+# is cached in __pycache__ (the script started by Python is compiled again on every run).
+
+from pathlib import Path
+import datetime
+import logging
+import sys
+import re
+import itertools
+import array
+import bisect
+import heapq
+import hashlib
+import contextlib
+import mmap
+import json
+import time
+import fnmatch
+import stat
+import os
+import signal
+import errno
+import threading
+import concurrent.futures
+import collections
+import struct
+# yaml (requires pyyaml: pip install pyyaml), sqlite3, subprocess, shlex, shutil, filecmp, ctypes, select and cProfile are imported
+# where they are needed, so they are only loaded if the config actually uses the respective feature.
+
+VERSION = "1.7 (17.10.2026)"
+MAX_LINE_LENGTH = 1048576 # longer lines are split when files are processed line by line
+MAX_DIFF_COST = 500 # sections of a diff which need more inserted or removed lines than this are shown as completely replaced
+MAX_DIFF_LINES = 1000 # default for 'max_diff_lines'
+MAX_FILE_SIZE_FOR_COMPLIANCE_CHECK = 1048576 # default for 'max_file_size': compliance rules matching across lines and multiline 'ignore_regex' are not applied to files bigger than 1MB (a quite conservative limit to avoid high mem usage)
+COMPLIANCE_CHUNK_SIZE = 16777216 # line based compliance checks decode files in chunks of about 16MB
+DEBUG = False
+JOBS = None # number of parallel jobs, overwrites 'parallelism' from config file if set
+REBUILD_INDEX = False
+WATCH = False # keep running and process repositories when new files arrive (Linux only)
+PLAN_ONLY = False # only print planned file operations as JSON, don't change any files
+CHECK_ONLY = False # only check the newest files of each repository, without pulls and clean up (e.g. for frequent monitoring polls)
+DELETE_WORKERS = 8 # number of threads deleting files at the same time
+MAX_PARALLEL_PULLS = 8 # default for 'max_parallel_pulls' (if there are enough repositories with a pull command)
+STATE_DB_FILE = "bck_mgmt.sqlite" # name of the database in 'state_dir'
+INTERNAL_PREFIX = ".bck_mgmt" # files created by the script itself (like temporary files) start with this and never match 'pattern'
+TRANSFER_CHUNK_SIZE = 4194304 # files moved to another filesystem are copied in chunks of 4MB
+FICLONE = 0x40049409 # ioctl to create a reflink (copy-on-write clone) of a file on Linux
+INTEGRITY_VERIFY_RUNS = 30 # default for 'verify_runs': all files of the integrity manifest are verified again within 30 runs
+INTEGRITY_WORKERS = 4 # default for 'workers' of 'integrity': number of files hashed at the same time
+HASH_BUFFER_SIZE = 8388608 # files of the integrity manifest are read in chunks of up to 8MB
+COMPRESSION = {'gzip': '.gz', 'bz2': '.bz2', 'lzma': '.xz'} # methods for 'compress' (names of the Python modules) and their file extensions
+LOCK_FILE = INTERNAL_PREFIX + ".lock" # advisory lock in the base directory of each repository, see RepoLock
+SHARD = None # (shard, shards): only process the repositories of this shard (--shard i/n)
+RESULTS = None # write the results of the repositories to this JSON file for --merge instead of reporting them
+MERGE = None # results files of all shards, which are combined to one report
+PROFILE = None # write cProfile stats of the whole run to this file
+PHASES = ('pull', 'scan', 'compliance', 'compare', 'retention', 'dedup', 'integrity') # phases of processing a repository, exported as <alias>_<phase>_ms
+SYSCALLS = ('scandir', 'stat', 'open', 'rename', 'unlink') # counted file system calls
+repo_metrics = threading.local() # metrics of the repository processed by the current thread, see count()
+
+conf_path = None # default config path can be set here
+CONFIG_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'bck_mgmt' # merged and validated configs
+CONFIG_CACHE_FILES = 16 # only the cache files of the configs written most recently are kept
+
+usage = """Usage:
+  {} -c <config> [-j <jobs>] [--rebuild-index] [--plan-only] [--check-only] [--watch] [--profile <file>] [--shard <i>/<n>] [--results <file>] [-d] [-h]
+  {} -c <config> --merge <results>...
+
+Options:
+  -c, --conf <config>  specify path to YAML config file. See example config for more information.
+  -j, --jobs <jobs>    number of backup repositories to process in parallel (overwrites 'parallelism' from config)
+  --rebuild-index      ignore the scan index and scan all directories again
+  --plan-only          don't pull, move or delete any files, print the planned file operations as JSON instead
+  --check-only         only check the newest files (age, size, compliance, comparison), don't pull, move or delete any files
+  --watch              keep running and process repositories as soon as new files arrive (Linux only)
+  --profile <file>     write cProfile statistics of the run to this file (processes the repositories one by one)
+  --shard <i>/<n>      only process the i-th of n parts of the backup repositories (see 'shard_by' in config)
+  --results <file>     write the results to this JSON file instead of executing the reporting command
+  --merge <results>... combine the results files of all shards to one report and execute the reporting command
+  -d, --debug          overwrites log config to DEBUG and STDOUT
+  -h, --help           display this help and exit
+  -v, --version        display version and exit""".format(sys.argv[0], sys.argv[0])
+
+
+def humanize_size(num, suffix='B'):
+    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f %s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f %s%s" % (num, 'Yi', suffix)
+
+def count(name, value=1):
+    # Adds value to a metric of the repository processed by the current thread (exported as perfdata and to the metrics file).
+    counters = getattr(repo_metrics, 'counters', None)
+    if counters is not None:
+        counters[name] = counters.get(name, 0) + value
+
+@contextlib.contextmanager
+def timed(name):
+    # measures the duration of a phase in milliseconds
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(name, (time.perf_counter() - start) * 1000)
+
+def compression_of(file):
+    # compression method of a file by its extension (None for uncompressed files)
+    extension = os.path.splitext(str(file))[1].lower()
+    for method, method_extension in COMPRESSION.items():
+        if extension == method_extension:
+            return method
+    return None
+
+@contextlib.contextmanager
+def open_file(file):
+    # Opens a file for reading in binary mode. Compressed files (see 'compress') are decompressed transparently while
+    # reading. Corrupt compressed data is raised as OSError, like read errors of uncompressed files.
+    method = compression_of(file)
+    if method is None:
+        with open(file, 'rb') as f:
+            yield f
+        return
+    import importlib
+    module = importlib.import_module(method)
+    errors = (EOFError, importlib.import_module('zlib').error) if method == 'gzip' else (EOFError, module.LZMAError) if method == 'lzma' else (EOFError,)
+    try:
+        with module.open(file, 'rb') as f:
+            yield f
+    except errors as err:
+        raise OSError(errno.EIO, "Cannot decompress '{}': {}".format(file, err)) from err
+
+@contextlib.contextmanager
+def map_file(file, max_size=None):
+    # Maps a file read-only into memory. The OS only pages in the parts which are accessed (and can drop them again),
+    # so memory usage stays flat no matter how big the file is.
+    # Compressed files can't be mapped. They are decompressed into memory instead, up to 'max_size' bytes.
+    if compression_of(file) is not None:
+        with open_file(file) as f:
+            count('open')
+            content = f.read(max_size + 1 if max_size is not None else -1)
+        count('bytes_read', len(content))
+        if max_size is not None and len(content) > max_size:
+            raise ValueError("Decompressed content of '{}' exceeds 'max_file_size' ({})".format(file, humanize_size(max_size)))
+        yield content
+        return
+    with open(file, 'rb') as f:
+        count('open')
+        size = os.fstat(f.fileno()).st_size
+        count('bytes_read', size)
+        if size == 0:
+            yield b'' # empty files can't be mapped
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                yield content
+
+
+def read_lines(file):
+    # reads a file line by line in binary mode, so it never has to be loaded completely
+    with open_file(file) as f:
+        count('open')
+        try:
+            yield from iter(lambda: f.readline(MAX_LINE_LENGTH), b'')
+        finally:
+            count('bytes_read', f.tell())
+
+def normalized_lines(file, pattern, max_file_size):
+    # Yields the content of a file line by line with all matches of 'ignore_regex' replaced by '[IGNORED]', so only one line
+    # has to be kept in memory. Regexes which can match across lines are applied to a memory map of the whole file instead.
+    # The content is decoded as UTF-8, so the regex matches characters. Invalid bytes are kept as surrogates, so files which
+    # only differ in them are still different.
+    if MULTILINE_REGEX_TOKENS.search(pattern.pattern):
+        if os.stat(file).st_size > max_file_size:
+            raise ValueError("File '{}' exceeds 'max_file_size' ({})".format(file, humanize_size(max_file_size)))
+        with map_file(file, max_file_size) as content:
+            yield pattern.sub('[IGNORED]', str(content, 'utf-8', 'surrogateescape'))
+        return
+    for line in read_lines(file):
+        line = line.decode('utf-8', 'surrogateescape')
+        # the line break is removed first, so the regex is applied exactly like to the whole content:
+        if line.endswith('\n'):
+            yield pattern.sub('[IGNORED]', line[:-1]) + '\n'
+        else:
+            yield pattern.sub('[IGNORED]', line)
+
+def normalized_hash(file, pattern, max_file_size, algorithm='sha256'):
+    file_hash = hashlib.new(algorithm)
+    for line in normalized_lines(file, pattern, max_file_size):
+        file_hash.update(line.encode('utf-8', 'surrogateescape'))
+    return file_hash.hexdigest()
+
+def normalized_files_equal(file1, file2, pattern, max_file_size):
+    # compares both files line by line after applying 'ignore_regex' and stops at the first difference
+    for line1, line2 in itertools.zip_longest(normalized_lines(file1, pattern, max_file_size), normalized_lines(file2, pattern, max_file_size)):
+        if line1 != line2:
+            return False
+    return True
+
+def hash_lines(file):
+    # Returns the hashes of all lines of a text file as compact integer array (line breaks are ignored).
+    # Hash collisions of different lines are theoretically possible, but very unlikely with 64 bit hashes.
+    hashes = array.array('q')
+    for line in read_lines(file):
+        if b'\0' in line:
+            raise ValueError("'{}' is not a text file".format(file))
+        hashes.append(hash(line.rstrip(b'\r\n')))
+    return hashes
+
+def unique_common_lines(a, a_lo, a_hi, b, b_lo, b_hi):
+    # Returns the longest increasing sequence of line pairs (index in a, index in b) of lines which occur exactly once
+    # in a[a_lo:a_hi] and in b[b_lo:b_hi].
+    unique_a = {}
+    for i in range(a_lo, a_hi):
+        unique_a[a[i]] = -1 if a[i] in unique_a else i
+    unique_b = {}
+    for j in range(b_lo, b_hi):
+        if b[j] in unique_a:
+            unique_b[b[j]] = -1 if b[j] in unique_b else j
+    # longest increasing subsequence of the indices in b (patience sorting):
+    pairs_a = array.array('q')
+    pairs_b = array.array('q')
+    predecessors = array.array('q')
+    pile_tops = [] # smallest index in b on top of each pile
+    pile_top_pairs = [] # number of the pair on top of each pile
+    for i in range(a_lo, a_hi):
+        j = unique_b.get(a[i], -1)
+        if j < 0 or unique_a[a[i]] != i:
+            continue
+        pile = bisect.bisect_left(pile_tops, j)
+        predecessors.append(pile_top_pairs[pile - 1] if pile > 0 else -1)
+        pairs_a.append(i)
+        pairs_b.append(j)
+        if pile == len(pile_tops):
+            pile_tops.append(j)
+            pile_top_pairs.append(len(pairs_a) - 1)
+        else:
+            pile_tops[pile] = j
+            pile_top_pairs[pile] = len(pairs_a) - 1
+    anchors = []
+    pair = pile_top_pairs[-1] if pile_top_pairs else -1
+    while pair >= 0:
+        anchors.append((pairs_a[pair], pairs_b[pair]))
+        pair = predecessors[pair]
+    anchors.reverse()
+    return anchors
+
+def middle_snake(a, a_lo, a_hi, b, b_lo, b_hi, max_cost):
+    # Searches the middle snake of the shortest edit script between a[a_lo:a_hi] and b[b_lo:b_hi] from both ends at the same time
+    # (linear space variant of the Myers diff algorithm). Returns start and end of the snake or None, if more than 2 * max_cost
+    # inserted or removed lines would be needed.
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta % 2 == 1
+    max_d = min((n + m + 1) // 2, max_cost)
+    offset = max_d + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[offset + delta - k] >= n:
+                return a_lo + x_start, b_lo + y_start, a_lo + x, b_lo + y
+        # backward search works on the reversed sequences:
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and x + forward[offset + delta - k] >= n:
+                return a_hi - x, b_hi - y, a_hi - x_start, b_hi - y_start
+    return None
+
+def diff_sections(a, a_lo, a_hi, b, b_lo, b_hi, changes, max_cost=MAX_DIFF_COST):
+    # Appends all changed sections (a_start, a_end, b_start, b_end) between a[a_lo:a_hi] and b[b_lo:b_hi] to 'changes'.
+    # Sections where the edit distance exceeds max_cost are treated as completely replaced, so the runtime is bounded.
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        a_lo += 1
+        b_lo += 1
+    while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+    if a_lo == a_hi and b_lo == b_hi:
+        return
+    snake = None
+    if a_lo < a_hi and b_lo < b_hi:
+        anchors = unique_common_lines(a, a_lo, a_hi, b, b_lo, b_hi)
+        if anchors:
+            # patience diff: lines occurring exactly once in both sections split them into smaller sections
+            for a_anchor, b_anchor in anchors:
+                diff_sections(a, a_lo, a_anchor, b, b_lo, b_anchor, changes, max_cost)
+                a_lo, b_lo = a_anchor + 1, b_anchor + 1
+            diff_sections(a, a_lo, a_hi, b, b_lo, b_hi, changes, max_cost)
+            return
+        snake = middle_snake(a, a_lo, a_hi, b, b_lo, b_hi, max_cost)
+    if snake is None:
+        if changes and changes[-1][1] == a_lo and changes[-1][3] == b_lo:
+            # merge with adjacent change:
+            changes[-1] = (changes[-1][0], a_hi, changes[-1][2], b_hi)
+        else:
+            changes.append((a_lo, a_hi, b_lo, b_hi))
+        return
+    x_start, y_start, x_end, y_end = snake
+    diff_sections(a, a_lo, x_start, b, b_lo, y_start, changes, max_cost)
+    diff_sections(a, x_end, a_hi, b, y_end, b_hi, changes, max_cost)
+
+def format_range(start, stop):
+    # line range of a hunk in unified diff format (like difflib)
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
+
+def log_diff(alias, file1, file2, header1, header2, max_lines, context=2):
+    # Logs the differences between two text files as unified diff at INFO level, one message per hunk. Only the line hashes
+    # of both files are kept in memory, the lines shown in the hunks are read again afterwards.
+    # At most max_lines lines are logged. Returns the number of added and removed lines.
+    a = hash_lines(file1)
+    b = hash_lines(file2)
+    changes = []
+    diff_sections(a, 0, len(a), b, 0, len(b), changes)
+    removed = sum(change[1] - change[0] for change in changes)
+    added = sum(change[3] - change[2] for change in changes)
+    if logging.getLogger().level > 20 or not changes:
+        return added, removed
+
+    # group changes into hunks like difflib.unified_diff():
+    hunks = [[changes[0]]]
+    for change in changes[1:]:
+        if change[0] - hunks[-1][-1][1] > 2 * context:
+            hunks.append([])
+        hunks[-1].append(change)
+
+    logging.info("{}: Differences ({} line{} added, {} line{} removed):\n--- {}\n+++ {}".format(
+        alias, added, "" if added == 1 else "s", removed, "" if removed == 1 else "s", header1, header2))
+    lines1 = read_lines(file1)
+    lines2 = read_lines(file2)
+    position = 0 # current line number in file1. Unchanged lines are shown from file1 and skipped in file2.
+    shown = 0
+    for hunk_num, hunk in enumerate(hunks):
+        a_start = max(0, hunk[0][0] - context)
+        a_end = min(len(a), hunk[-1][1] + context)
+        b_start = hunk[0][2] - (hunk[0][0] - a_start)
+        b_end = hunk[-1][3] + (a_end - hunk[-1][1])
+        output = ["{}: @@ -{} +{} @@".format(alias, format_range(a_start, a_end), format_range(b_start, b_end))]
+        for lines in (lines1, lines2):
+            for _ in itertools.islice(lines, a_start - position):
+                pass
+        position = a_start
+        for a_lo, a_hi, b_lo, b_hi in hunk + [(a_end, a_end, b_end, b_end)]:
+            # unchanged lines before the change, removed lines, added lines:
+            for prefix, lines, length in ((' ', lines1, a_lo - position), (None, lines2, a_lo - position), ('-', lines1, a_hi - a_lo), ('+', lines2, b_hi - b_lo)):
+                for line in itertools.islice(lines, length):
+                    if prefix is None:
+                        continue
+                    if shown < max_lines:
+                        output.append(prefix + line.rstrip(b'\r\n').decode(errors='replace'))
+                    shown += 1
+            position = a_hi
+            if shown > max_lines:
+                break
+        logging.info('\n'.join(output))
+        if shown > max_lines:
+            logging.info("{}: Diff log truncated after {} lines ('max_diff_lines'). {} more hunk{} not logged. ".format(
+                alias, max_lines, len(hunks) - hunk_num - 1, "" if len(hunks) - hunk_num - 1 == 1 else "s"))
+            break
+    lines1.close()
+    lines2.close()
+    return added, removed
+
+def compressed_extensions(repo):
+    # extensions of the files compressed by a repository ('compress' of its weekly, monthly and yearly directories)
+    return tuple(extension for method, extension in COMPRESSION.items() if any(period in repo.keys() and type(repo[period]) is dict
+        and repo[period].get('compress') == method for period in ('weekly', 'monthly', 'yearly')))
+
+def compile_pattern(pattern, extensions=()):
+    # Splits a glob pattern like "**/Test2*.bck" into its path segments and precompiles each segment with fnmatch.
+    # '**' (any number of subdirectories, including none) is represented by None. The file name also matches, if it
+    # is followed by one of the given extensions (of the files compressed by the repository, see compressed_extensions).
+    flags = re.IGNORECASE if os.name == 'nt' else 0
+    parts = Path(pattern).parts
+    segments = [None if part == '**' else re.compile(fnmatch.translate(part), flags) for part in parts[:-1]]
+    if parts[-1] == '**':
+        return segments + [None]
+    return segments + [re.compile('|'.join(fnmatch.translate(parts[-1] + extension) for extension in ('',) + tuple(extensions)), flags)]
+
+def expand_pattern_states(segments, states):
+    # a '**' segment may match zero directories, so the following segment has to be tried as well:
+    expanded = set()
+    for i in states:
+        while i < len(segments) and segments[i] is None:
+            expanded.add(i)
+            i += 1
+        if i < len(segments):
+            expanded.add(i)
+    return expanded
+
+def match_name(segments, name):
+    # checks if a file directly inside the scanned directory would match the pattern
+    last = len(segments) - 1
+    return any(i == last and segments[i] is not None and segments[i].match(name) for i in expand_pattern_states(segments, {0}))
+
+class FileTable:
+    # Compact table of scanned files for directories with millions of files. Instead of a (mtime, Path, size) tuple per
+    # file, mtimes and sizes are stored in arrays and all names in one bytes buffer, together with the number of their
+    # directory. Path objects are only created for files which are actually used (like the newest file or files which are
+    # moved or deleted). 'order' contains the row numbers of the files, sorted by mtime after sort().
+    ENCODING = sys.getfilesystemencoding()
+    ERRORS = sys.getfilesystemencodeerrors()
+
+    def __init__(self):
+        self.mtimes = array.array('d')
+        self.sizes = array.array('q')
+        self.dir_nums = array.array('q')
+        self.name_ends = array.array('q') # end of the name of each row in 'names'
+        self.names = bytearray()
+        self.dirs = []
+        self.dir_map = {}
+        self.order = array.array('q')
+
+    def __len__(self):
+        return len(self.order)
+
+    def copy(self):
+        table = FileTable()
+        table.mtimes = array.array('d', self.mtimes)
+        table.sizes = array.array('q', self.sizes)
+        table.dir_nums = array.array('q', self.dir_nums)
+        table.name_ends = array.array('q', self.name_ends)
+        table.names = bytearray(self.names)
+        table.dirs = list(self.dirs)
+        table.dir_map = dict(self.dir_map)
+        table.order = array.array('q', self.order)
+        return table
+
+    def directory(self, path):
+        # number of a directory (as string), it's added to the table if needed
+        num = self.dir_map.get(path)
+        if num is None:
+            num = self.dir_map[path] = len(self.dirs)
+            self.dirs.append(path)
+        return num
+
+    def add(self, dir_num, name, mtime, size):
+        # adds a file at the end of 'order' and returns its row number
+        row = len(self.mtimes)
+        self.mtimes.append(mtime)
+        self.sizes.append(size)
+        self.dir_nums.append(dir_num)
+        self.names += name.encode(self.ENCODING, self.ERRORS)
+        self.name_ends.append(len(self.names))
+        self.order.append(row)
+        return row
+
+    def truncate(self, rows):
+        # removes all rows added after the first 'rows' rows (before sort())
+        del self.mtimes[rows:], self.sizes[rows:], self.dir_nums[rows:], self.order[rows:]
+        del self.names[self.name_ends[rows - 1] if rows else 0:], self.name_ends[rows:]
+
+    def name(self, row):
+        return self.names[self.name_ends[row - 1] if row else 0:self.name_ends[row]].decode(self.ENCODING, self.ERRORS)
+
+    def path(self, row):
+        return Path(self.dirs[self.dir_nums[row]], self.name(row))
+
+    def sort(self):
+        # Sorts 'order' like sorted() sorts (mtime, path, size) tuples, but paths are only compared for files with the same
+        # mtime: the rows are sorted by mtime first, then each run of equal mtimes is sorted by path.
+        order = sorted(self.order, key=self.mtimes.__getitem__)
+        if len(set(map(self.mtimes.__getitem__, order))) < len(order):
+            start = 0
+            for end in range(1, len(order) + 1):
+                if end == len(order) or self.mtimes[order[end]] != self.mtimes[order[start]]:
+                    if end - start > 1:
+                        order[start:end] = sorted(order[start:end], key=self.path)
+                    start = end
+        self.order = array.array('q', order)
+        return self
+
+def scan_single_directory(path, segments, states, table):
+    # Scans one directory. Adds the matching files in it to 'table' and returns the subdirectories which have to be
+    # scanned as well together with their pattern states.
+    dir_num = None
+    subdirs = {}
+    last = len(segments) - 1
+    states = expand_pattern_states(segments, states)
+    count('scandir')
+    with os.scandir(path) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith(INTERNAL_PREFIX):
+                continue
+            if any(i == last and segments[i] is not None and segments[i].match(name) for i in states):
+                try:
+                    count('stat')
+                    st = entry.stat()
+                except OSError:
+                    continue # e.g. broken symlink
+                if stat.S_ISREG(st.st_mode):
+                    if dir_num is None:
+                        dir_num = table.directory(path)
+                    table.add(dir_num, name, st.st_mtime, st.st_size)
+                    continue
+            # descend into subdirectories, if a following segment might match. Like pathlib, '**' does not follow symlinks:
+            recursive_states = set(i for i in states if segments[i] is None)
+            next_states = set(i + 1 for i in states if i < last and segments[i] is not None and segments[i].match(name))
+            if not (recursive_states or next_states):
+                continue
+            try:
+                if not entry.is_dir():
+                    continue
+                if not entry.is_symlink():
+                    next_states |= recursive_states
+            except OSError:
+                continue
+            if next_states:
+                subdirs[entry.path] = next_states
+    return subdirs
+
+def scan_directory(directory, segments, scan_function=None):
+    # Single pass directory scanner based on os.scandir. Equivalent to Path(directory).glob(pattern), but each matching file
+    # is stat'ed only once. Non-matching entries are not stat'ed at all, as the file type is taken from the cached DirEntry data.
+    # A different function for scanning single directories can be given (used by the scan index).
+    # Returns a FileTable sorted by mtime.
+    table = FileTable()
+    pending = [(str(directory), {0})]
+    while pending:
+        path, states = pending.pop()
+        rows = len(table.mtimes)
+        try:
+            if scan_function is not None:
+                subdirs = scan_function(path, states, table)
+            else:
+                subdirs = scan_single_directory(path, segments, states, table)
+        except OSError as err:
+            logging.debug("Cannot scan directory '{}': {}".format(path, err))
+            table.truncate(rows)
+            continue
+        pending.extend(subdirs.items())
+    return table.sort()
+
+class NewestFiles:
+    # Keeps only the newest 'n' files of a scan in a heap of (mtime, path, size) and the number and total size of all files,
+    # so the newest files of a huge directory are found in one pass with constant memory. Provides the methods of FileTable
+    # used by scan_single_directory(). Path objects are only created for files which are newer than the oldest file in the
+    # heap. Like FileTable.sort(), files with the same mtime are ordered by path.
+
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.files = 0
+        self.size = 0
+
+    def directory(self, path):
+        return path
+
+    def add(self, directory, name, mtime, size):
+        self.files += 1
+        self.size += size
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, (mtime, Path(directory, name), size))
+        elif mtime >= self.heap[0][0]:
+            heapq.heappushpop(self.heap, (mtime, Path(directory, name), size))
+
+    def table(self):
+        # the newest files as sorted FileTable
+        table = FileTable()
+        for mtime, path, size in sorted(self.heap):
+            table.add(table.directory(str(path.parent)), path.name, mtime, size)
+        return table
+
+def scan_newest(directory, segments, n=2):
+    # Scans like scan_directory(), but only returns the newest n files as FileTable together with the number and total size
+    # of all matching files (see NewestFiles).
+    newest = NewestFiles(n)
+    pending = [(str(directory), {0})]
+    while pending:
+        path, states = pending.pop()
+        try:
+            subdirs = scan_single_directory(path, segments, states, newest)
+        except OSError as err:
+            logging.debug("Cannot scan directory '{}': {}".format(path, err))
+            continue
+        pending.extend(subdirs.items())
+    return newest.table(), newest.files, newest.size
+
+def hash_file(file, algorithm='sha256', buffer_size=1048576, decompress=True):
+    # streaming hash of a file (of the decompressed content for compressed files, unless 'decompress' is False), reading it
+    # in chunks into a reused buffer
+    file_hash = hashlib.new(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open_file(file) if decompress else open(file, 'rb') as f:
+        count('open')
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            count('bytes_read', n)
+            file_hash.update(view[:n])
+    return file_hash.hexdigest()
+
+def contents_equal(file1, file2, buffer_size=1048576):
+    # compares two files byte by byte (the decompressed content of compressed files) without using any stored hashes
+    with open_file(file1) as f1, open_file(file2) as f2:
+        count('open', 2)
+        while True:
+            chunk1 = f1.read(buffer_size)
+            chunk2 = f2.read(buffer_size)
+            count('bytes_read', len(chunk1) + len(chunk2))
+            if chunk1 != chunk2:
+                return False
+            if not chunk1:
+                return True
+
+def open_state_db(state_dir):
+    # database for all persistent state in 'state_dir'. Each thread has to use its own connection.
+    import sqlite3
+    db = sqlite3.connect(str(state_dir / STATE_DB_FILE), timeout = 60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS scan_dir (root TEXT, pattern TEXT, directory TEXT, mtime_ns INTEGER, subdirs TEXT, PRIMARY KEY (root, pattern, directory))")
+    db.execute("CREATE TABLE IF NOT EXISTS scan_file (root TEXT, pattern TEXT, directory TEXT, name TEXT, mtime REAL, size INTEGER, PRIMARY KEY (root, pattern, directory, name))")
+    # content hashes of files (of the decompressed content for compressed files). 'regex' is the 'ignore_regex' applied
+    # before hashing (empty for the plain content):
+    db.execute("CREATE TABLE IF NOT EXISTS normalized_digest (path TEXT, regex TEXT, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT, last_used REAL, PRIMARY KEY (path, regex))")
+    db.execute("CREATE INDEX IF NOT EXISTS normalized_digest_inode ON normalized_digest (dev, ino)")
+    # files which share their data with other files of the same content through reflinks ('dedup: reflink'):
+    db.execute("CREATE TABLE IF NOT EXISTS dedup_clone (dev INTEGER, ino INTEGER, mtime_ns INTEGER, digest TEXT, last_used REAL, PRIMARY KEY (dev, ino))")
+    # integrity manifest: SHA-256 of the raw content of all files of a repository and when it was last verified ('integrity'):
+    db.execute("CREATE TABLE IF NOT EXISTS integrity (root TEXT, pattern TEXT, path TEXT, size INTEGER, mtime REAL, digest TEXT, verified REAL, PRIMARY KEY (root, pattern, path))")
+    return db
+
+class ScanIndex:
+    # Persistent index of scanned directories, stored in a SQLite database in 'state_dir'. A directory is only scanned
+    # again if its mtime changed since the last run. Directories in which this script moves or deletes files are scanned again as well.
+    # Note: Overwriting an existing file doesn't change the mtime of its directory, so such changes are not detected!
+    # Without a database file, all directories are scanned and file operations are just executed.
+
+    RACY_SECONDS = 2 # directories modified less than this before the scan are scanned again next time (mtime granularity)
+
+    def __init__(self, db=None, rebuild=False):
+        self.rebuild = rebuild
+        self.db = db
+
+    def scan_directory(self, root, pattern, segments):
+        if self.db is None:
+            return scan_directory(root, segments)
+
+        root = str(Path(root))
+        known_dirs = {}
+        known_files = {}
+        visited = set()
+        scanned = []
+        if not self.rebuild:
+            for directory, mtime_ns, subdirs in self.db.execute("SELECT directory, mtime_ns, subdirs FROM scan_dir WHERE root = ? AND pattern = ?", (root, pattern)):
+                known_dirs[directory] = (mtime_ns, subdirs)
+            for directory, name, mtime, size in self.db.execute("SELECT directory, name, mtime, size FROM scan_file WHERE root = ? AND pattern = ?", (root, pattern)):
+                known_files.setdefault(directory, []).append((name, mtime, size))
+
+        def cached_scan(path, states, table):
+            visited.add(path)
+            count('stat')
+            mtime_ns = os.stat(path).st_mtime_ns
+            if path in known_dirs.keys() and known_dirs[path][0] == mtime_ns:
+                if path in known_files.keys():
+                    dir_num = table.directory(path)
+                    for name, mtime, size in known_files.pop(path):
+                        table.add(dir_num, name, mtime, size)
+                subdirs = json.loads(known_dirs[path][1])
+                return dict((subdir, set(sub_states)) for subdir, sub_states in subdirs.items())
+
+            rows = len(table.mtimes)
+            subdirs = scan_single_directory(path, segments, states, table)
+            scanned.append(path)
+            if time.time() - mtime_ns / 1e9 < self.RACY_SECONDS:
+                mtime_ns = -1 # the directory might still change within the same mtime tick
+            self.db.execute("DELETE FROM scan_file WHERE root = ? AND pattern = ? AND directory = ?", (root, pattern, path))
+            self.db.executemany("INSERT INTO scan_file VALUES (?, ?, ?, ?, ?, ?)",
+                ((root, pattern, path, table.name(row), table.mtimes[row], table.sizes[row]) for row in range(rows, len(table.mtimes))))
+            self.db.execute("INSERT OR REPLACE INTO scan_dir VALUES (?, ?, ?, ?, ?)",
+                (root, pattern, path, mtime_ns, json.dumps(dict((subdir, sorted(sub_states)) for subdir, sub_states in subdirs.items()))))
+            return subdirs
+
+        result = scan_directory(root, segments, cached_scan)
+        # forget directories which don't exist anymore:
+        for directory in set(known_dirs.keys()) - visited:
+            self.db.execute("DELETE FROM scan_dir WHERE root = ? AND pattern = ? AND directory = ?", (root, pattern, directory))
+            self.db.execute("DELETE FROM scan_file WHERE root = ? AND pattern = ? AND directory = ?", (root, pattern, directory))
+        self.db.commit()
+        logging.debug("Scan index: {} of {} directories below '{}' had to be scanned. ".format(len(scanned), len(visited), root))
+        return result
+
+    def update(self, operation, removed=None, added=None):
+        # Executes a file operation (move or delete) and applies it to the index. 'added' is a (path, mtime, size) tuple.
+        result = []
+        def execute():
+            result.append(operation())
+            return [(removed, added)]
+        self.update_batch([(removed, added)], execute)
+        return result[0]
+
+    def update_batch(self, changes, execute):
+        # Executes a batch of file operations by calling execute() and applies them to the index. 'changes' contains
+        # (removed, added) tuples of all planned operations, execute() returns the ones which actually succeeded.
+        # Files written by other processes while the batch is executed (e.g. a new backup file) change the mtime of the
+        # directory just like the batch itself, so all directories touched by the batch are scanned again in the next run.
+        applied = execute()
+        if self.db is None:
+            return applied
+        directories = set(str(Path(path).parent) for removed, added in changes for path in (removed, added[0] if added else None) if path is not None)
+        for directory in directories:
+            self.db.execute("UPDATE scan_dir SET mtime_ns = -1 WHERE directory = ?", (directory,))
+        self.db.commit()
+        return applied
+
+
+class DigestStore:
+    # Remembers the content hash of every file compared so far (SQLite database in 'state_dir'). A stored hash is only used,
+    # if size and mtime of the file are unchanged, so usually only the newest file has to be read when comparing it with the previous one.
+    # Files moved by this script keep their inode, so their hash is found again under the new path.
+    # Hashes of the content after applying 'ignore_regex' are stored the same way, separately for each regex.
+    # Without a database, files are compared byte by byte (or line by line after applying 'ignore_regex').
+
+    EXPIRE_DAYS = 30 # hashes not used for this many days are removed
+
+    def __init__(self, db=None):
+        self.db = db
+
+    def digest(self, file, ignore_pattern=None, max_file_size=None):
+        # Returns the hash of the file content. If 'ignore_pattern' is given, the hash of the content after applying 'ignore_regex'
+        # is returned instead. These are stored separately for each regex.
+        if self.db is None:
+            return normalized_hash(file, ignore_pattern, max_file_size) if ignore_pattern is not None else hash_file(file)
+        count('stat')
+        st = os.stat(file)
+        path = str(file)
+        regex = ignore_pattern.pattern if ignore_pattern is not None else ""
+        row = self.db.execute("SELECT digest FROM normalized_digest WHERE path = ? AND regex = ? AND dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+            (path, regex, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        if row is None:
+            row = self.db.execute("SELECT digest FROM normalized_digest WHERE regex = ? AND dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                (regex, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        if row is not None:
+            digest = row[0]
+        elif ignore_pattern is not None:
+            logging.debug("Calculating hash of file '{}' after applying 'ignore_regex'. ".format(file))
+            digest = normalized_hash(file, ignore_pattern, max_file_size)
+        else:
+            logging.debug("Calculating hash of file '{}'. ".format(file))
+            digest = hash_file(file)
+        self.db.execute("DELETE FROM normalized_digest WHERE regex = ? AND (path = ? OR (dev = ? AND ino = ?))", (regex, path, st.st_dev, st.st_ino))
+        self.db.execute("INSERT INTO normalized_digest VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (path, regex, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest, time.time()))
+        self.db.commit()
+        return digest
+
+    def files_equal(self, file1, file2):
+        if compression_of(file1) is not None or compression_of(file2) is not None:
+            # compressed files are compared by their decompressed content, their headers (name, mtime) differ anyway:
+            return self.digest(file1) == self.digest(file2)
+        if self.db is None:
+            import filecmp
+            count('stat', 2)
+            count('open', 2)
+            count('bytes_read', 2 * os.stat(file1).st_size)
+            return filecmp.cmp(file1, file2, shallow=False)
+        count('stat', 2)
+        if os.stat(file1).st_size != os.stat(file2).st_size:
+            return False
+        return self.digest(file1) == self.digest(file2)
+
+    def normalized_files_equal(self, file1, file2, ignore_pattern, max_file_size):
+        # compares the content of both files after applying 'ignore_regex'
+        if self.db is None:
+            return normalized_files_equal(file1, file2, ignore_pattern, max_file_size)
+        return self.digest(file1, ignore_pattern, max_file_size) == self.digest(file2, ignore_pattern, max_file_size)
+
+    def is_clone(self, st, digest):
+        # True if the file was already replaced by a reflink (or was the source of one) and didn't change since
+        if self.db is None:
+            return False
+        cursor = self.db.execute("UPDATE dedup_clone SET last_used = ? WHERE dev = ? AND ino = ? AND mtime_ns = ? AND digest = ?",
+            (time.time(), st.st_dev, st.st_ino, st.st_mtime_ns, digest))
+        return cursor.rowcount > 0
+
+    def add_clone(self, st, digest):
+        self.db.execute("INSERT OR REPLACE INTO dedup_clone VALUES (?, ?, ?, ?, ?)", (st.st_dev, st.st_ino, st.st_mtime_ns, digest, time.time()))
+
+    def expire(self):
+        if self.db is not None:
+            self.db.execute("DELETE FROM normalized_digest WHERE last_used < ?", (time.time() - self.EXPIRE_DAYS * 86400,))
+            self.db.execute("DELETE FROM dedup_clone WHERE last_used < ?", (time.time() - self.EXPIRE_DAYS * 86400,))
+            self.db.commit()
+
+# escapes, classes and flags which can match a line break or look beyond the current line:
+MULTILINE_REGEX_TOKENS = re.compile(r'\\[nsDWAZxuUN0-9]|\[\^|\(\?[aiLmux]*s|\(\?<[=!]|\n')
+
+def compile_compliance_checks(checks):
+    # Compiles the compliance checks of a repository once at config load and validates regexes and violation messages.
+    # Returns the compiled rule set and a list of errors.
+    rules = []
+    errors = []
+    for check in checks:
+        rule = {
+            'regex': check['regex'],
+            'must_not_match': True if 'must_not_match' in check.keys() and check['must_not_match'] else False,
+            'violation_message': check['violation_message'] if 'violation_message' in check.keys() else None
+        }
+        try:
+            rule['pattern'] = re.compile(rule['regex'], flags=re.MULTILINE)
+        except re.error as err:
+            errors.append("Invalid regex '{}' in compliance_check: {}. ".format(rule['regex'], err))
+            continue
+        # backreferences in violation_message are only expanded, if the regex matches:
+        if rule['must_not_match'] and rule['violation_message'] is not None:
+            try:
+                rule['pattern'].sub(rule['violation_message'], '') # parses the template without needing a match
+            except (re.error, IndexError) as err:
+                errors.append("Invalid violation_message '{}' in compliance_check: {}. ".format(rule['violation_message'], err))
+                continue
+        # rules which can't match across line boundaries are evaluated line by line in a single pass:
+        rule['line_based'] = not MULTILINE_REGEX_TOKENS.search(rule['regex'])
+        rules.append(rule)
+
+    # a combined regex of all line based rules finds the lines on which at least one of them matches:
+    prefilter = None
+    for rule in rules:
+        if rule['line_based']:
+            try:
+                prefilter = re.compile((prefilter.pattern + '|' if prefilter else '') + '(?:' + rule['pattern'].pattern + ')', flags=re.MULTILINE)
+            except re.error:
+                rule['line_based'] = False # e.g. duplicate group names or inline flags. This rule searches the whole content instead.
+    return {'rules': rules, 'prefilter': prefilter}, errors
+
+def dump_compliance_checks(rule_set):
+    # JSON serializable form of a compiled and validated rule set for the config cache (compiled regexes can't be stored).
+    return {'rules': [dict((key, rule[key]) for key in ('regex', 'must_not_match', 'violation_message', 'line_based')) for rule in rule_set['rules']],
+            'prefilter': rule_set['prefilter'].pattern if rule_set['prefilter'] else None}
+
+def load_compliance_checks(cached):
+    # Compiles a rule set from the config cache again. The regexes are known to be valid, so no validation is needed.
+    rules = [dict(rule, pattern=re.compile(rule['regex'], flags=re.MULTILINE)) for rule in cached['rules']]
+    prefilter = re.compile(cached['prefilter'], flags=re.MULTILINE) if cached['prefilter'] else None
+    return {'rules': rules, 'prefilter': prefilter}
+
+def decoded_chunks(content, chunk_size=COMPLIANCE_CHUNK_SIZE):
+    # Decodes the content (bytes or mmap) as UTF-8 in chunks of whole lines, so only one chunk has to be kept in memory as text.
+    # A line break never occurs inside a multibyte character, so splitting after line breaks is safe. Invalid bytes are replaced.
+    # Yields tuples of (text, last chunk).
+    start = 0
+    while True:
+        end = start + chunk_size
+        if end >= len(content):
+            end = len(content)
+        else:
+            line_end = content.find(b'\n', end - 1)
+            end = len(content) if line_end == -1 else line_end + 1
+        yield str(content[start:end], 'utf-8', 'replace'), end == len(content)
+        if end == len(content):
+            return
+        start = end
+
+def run_compliance_checks(rule_set, content):
+    # Applies all rules to the content (bytes or mmap) decoded as UTF-8, so the regexes match characters instead of bytes.
+    # Rules which can match across lines search the whole decoded content.
+    # Line based rules are evaluated together in a single pass over the content, which is decoded in chunks of whole lines:
+    # the prefilter finds the next line where any of them matches and only the rules not matched yet are applied to this line.
+    # Each rule is done after its first match.
+    # Returns a list of (rule, match) tuples in rule order and a list of the time spent per rule in seconds. The compiled rules
+    # are shared by all runs (watch mode, config cache), so they are never changed.
+    matches = {}
+    times = dict((id(rule), 0.0) for rule in rule_set['rules'])
+    pending = []
+    text = None
+    for rule in rule_set['rules']:
+        if rule['line_based']:
+            pending.append(rule)
+        else:
+            if text is None:
+                text = str(content, 'utf-8', 'replace')
+            start = time.perf_counter()
+            matches[id(rule)] = rule['pattern'].search(text)
+            times[id(rule)] += time.perf_counter() - start
+
+    for chunk, last in ([(text, True)] if text is not None else decoded_chunks(content)):
+        pos = 0
+        # the position after the final line break only starts a line in the last chunk:
+        while pending and (pos < len(chunk) or (last and pos == len(chunk))):
+            match = rule_set['prefilter'].search(chunk, pos)
+            if not match or (not last and match.start() == len(chunk)):
+                break
+            line_start = chunk.rfind('\n', 0, match.start()) + 1
+            line_end = chunk.find('\n', match.start())
+            if line_end == -1:
+                line_end = len(chunk)
+            line = chunk[line_start:line_end]
+            for rule in list(pending):
+                start = time.perf_counter()
+                rule_match = rule['pattern'].search(line)
+                times[id(rule)] += time.perf_counter() - start
+                if rule_match:
+                    matches[id(rule)] = rule_match
+                    pending.remove(rule)
+            pos = line_end + 1
+        if not pending:
+            break
+
+    return [(rule, matches.get(id(rule))) for rule in rule_set['rules']], [times[id(rule)] for rule in rule_set['rules']]
+
+def repo_alias(repo):
+    if 'alias' in repo.keys():
+        return repo['alias']
+    else:
+        return str(Path(repo['directory']))
+
+def merge_defaults(repo, parsed_config):
+    # load defaults for config entries not defined for current dir:
+    if 'defaults' in parsed_config.keys() and type(parsed_config['defaults']) is dict:
+        for key in parsed_config['defaults'].keys():
+            if not key in repo.keys():
+                repo[key] =  parsed_config['defaults'][key]
+            # merge dicts (like 'weekly:' etc.): 
+            elif type(repo[key]) is dict and type(parsed_config['defaults'][key]) is dict:
+                repo[key] = {**parsed_config['defaults'][key], **repo[key]}
+            # combine lists (only used for compliance checks at the moment):
+            # if the following two lines are commented out, lists defined for one directory will overwrite lists defined in defaults section:
+            elif type(repo[key]) is list and type(parsed_config['defaults'][key]) is list:
+                repo[key] = parsed_config['defaults'][key] + repo[key]
+        logging.debug("{}: Resulting merged config:\n{}".format(repo_alias(repo), repo))
+
+def log_stream(stream, level, message):
+    # log the output of a command line by line as soon as it arrives instead of buffering all of it:
+    for line in iter(stream.readline, b''):
+        line = line.decode(errors='ignore').rstrip('\r\n')
+        if line:
+            logging.log(level, message.format(line))
+    stream.close()
+
+def kill_process_tree(process):
+    # the command was started in its own session / process group, so children (like ssh spawned by scp) are killed as well:
+    if os.name == 'nt':
+        import subprocess
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output = True)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+def run_pull(repo, pull_slots, host_slots):
+    import subprocess, shlex
+    alias = repo_alias(repo)
+    current_dir = Path(repo['directory'])
+    pull_cfg = repo['pull']
+
+    # wait for a free slot for the host (if defined) first and then for a global slot, so waiting for a busy host doesn't block other pulls:
+    host_slot = host_slots[pull_cfg['host']] if 'host' in pull_cfg.keys() and pull_cfg['host'] in host_slots.keys() else None
+    if host_slot:
+        host_slot.acquire()
+    try:
+        with pull_slots:
+            start = time.perf_counter()
+            command = datetime.datetime.now().strftime(pull_cfg['command'])
+            logging.debug("{}: Executing pull command: {}".format(alias, command))
+            if 'shell' in pull_cfg.keys() and pull_cfg['shell']:
+                shell = True
+            else:
+                shell = False
+                command = shlex.split(command)
+            if os.name == 'nt':
+                process_group = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+            else:
+                process_group = {'start_new_session': True}
+            process = subprocess.Popen(command,
+                shell = shell,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE,
+                cwd = current_dir,
+                **process_group)
+            readers = [
+                threading.Thread(target=log_stream, args=(process.stdout, logging.INFO, alias + ": Output of pull command: {}")),
+                threading.Thread(target=log_stream, args=(process.stderr, logging.ERROR, alias + ": An error occurred during execution of pull command: {}"))
+            ]
+            for reader in readers:
+                reader.start()
+            try:
+                process.wait(timeout = pull_cfg['timeout'] if 'timeout' in pull_cfg.keys() else None)
+            except subprocess.TimeoutExpired:
+                logging.error("{}: Timeout for pull command expired.".format(alias))
+                kill_process_tree(process)
+                process.wait()
+            for reader in readers:
+                reader.join()
+            return (time.perf_counter() - start) * 1000 # duration in ms (without waiting for a free slot)
+    finally:
+        if host_slot:
+            host_slot.release()
+
+def bucket_key(mtime, period):
+    # Returns the year, month or ISO week a file belongs to as integer (e.g. 2024, 202405 or 202419).
+    date = datetime.date.fromtimestamp(mtime)
+    if period == 'yearly':
+        return date.year
+    if period == 'monthly':
+        return date.year * 100 + date.month
+    iso_year, iso_week = date.isocalendar()[:2]
+    return iso_year * 100 + iso_week
+
+def list_names(directory):
+    # names of all files in a directory, used to check if destination files already exist
+    return set(os.path.normcase(name) for name in os.listdir(directory))
+
+def plan_retention(repo, file_table, subdir_paths, move_old_path, subdir_files, pattern_segments, names_in=list_names, keep_actions=False):
+    # Decides what happens to each file of a repository without changing anything on the file system.
+    # subdir_paths contains the existing weekly, monthly and yearly directories, subdir_files their scan results.
+    # Returns a list of actions in the order they have to be executed. Each action is a dict with the keys
+    # 'action' ('keep', 'move', 'delete', 'would_delete' or 'conflict'), 'subdir' (None for the base directory),
+    # 'file', 'destination', 'mtime' and 'size'. Moves into a directory with 'compress' also have a 'compress' key.
+    # Files which are kept only get an action with 'keep_actions' or if they were moved in the same run, so no Path objects
+    # are created for them. Their number and total size are returned together with the actions.
+    actions = []
+    kept_files = kept_size = 0
+    subdir_files = dict((path, files.copy()) for path, files in subdir_files.items())
+    moved_in = dict((path, set()) for path in subdir_files.keys()) # rows of the files moved into a subdirectory
+    used_buckets = dict((period, set(bucket_key(subdir_files[path].mtimes[row], period) for row in subdir_files[path].order)) for period, path in subdir_paths.items())
+    delete_old = 'delete_old' in repo.keys() and repo['delete_old']
+    now = datetime.datetime.now()
+    existing_names = {}
+
+    def reserve(destination):
+        # every destination directory is only listed once, planned moves are added to the list:
+        directory = destination.parent
+        if not directory in existing_names.keys():
+            existing_names[directory] = names_in(directory)
+        name = os.path.normcase(destination.name)
+        if name in existing_names[directory]:
+            return False
+        existing_names[directory].add(name)
+        return True
+
+    def release(file):
+        if file.parent in existing_names.keys():
+            existing_names[file.parent].discard(os.path.normcase(file.name))
+
+    # base directory: move old files into yearly, monthly or weekly directory, if there is no file of the same period yet:
+    keep = int(repo['keep']) if 'keep' in repo.keys() else None
+    old = max(len(file_table) - keep, 0) if keep is not None else 0
+    for row in file_table.order[:old]:
+        mtime = file_table.mtimes[row]
+        size = file_table.sizes[row]
+        file = file_table.path(row)
+        action = {'action': 'keep', 'subdir': None, 'file': file, 'destination': None, 'mtime': mtime, 'size': size}
+        actions.append(action)
+
+        if 'rename_moved_files' in repo.keys():
+            filename = now.strftime(repo['rename_moved_files'].format(file.name))
+        else:
+            filename = file.name
+        for period in ('yearly', 'monthly', 'weekly'):
+            if period in subdir_paths.keys():
+                bucket = bucket_key(mtime, period)
+                if not bucket in used_buckets[period]:
+                    used_buckets[period].add(bucket)
+                    action['destination'] = subdir_paths[period] / filename
+                    # compress the file while moving it (unless it is already compressed):
+                    if 'compress' in repo[period].keys() and repo[period]['compress'] and compression_of(filename) is None:
+                        action['compress'] = repo[period]['compress']
+                        action['destination'] = subdir_paths[period] / (filename + COMPRESSION[action['compress']])
+                    break
+        else:
+            if move_old_path:
+                action['destination'] = move_old_path / filename
+
+        if action['destination'] is not None:
+            if reserve(action['destination']):
+                action['action'] = 'move'
+                release(file)
+                # the moved file takes part in the clean up of the subdirectory:
+                directory = action['destination'].parent
+                if directory in subdir_files.keys() and match_name(pattern_segments, action['destination'].name):
+                    table = subdir_files[directory]
+                    moved_in[directory].add(table.add(table.directory(str(directory)), action['destination'].name, mtime, size))
+            else:
+                action['action'] = 'conflict'
+        elif delete_old:
+            action['action'] = 'delete'
+        else:
+            action['action'] = 'would_delete'
+    for row in file_table.order[old:]:
+        if keep_actions:
+            actions.append({'action': 'keep', 'subdir': None, 'file': file_table.path(row), 'destination': None, 'mtime': file_table.mtimes[row], 'size': file_table.sizes[row]})
+        else:
+            kept_files += 1
+            kept_size += file_table.sizes[row]
+
+    # subdirectories: keep the newest files, move the others to 'move_old_to' or delete them:
+    for table in subdir_files.values():
+        table.sort()
+    for period, path in subdir_paths.items():
+        keep = int(repo[period]['keep'])
+        table = subdir_files[path]
+        for file_num, row in enumerate(reversed(table.order)):
+            mtime = table.mtimes[row]
+            size = table.sizes[row]
+            if file_num < keep and not (keep_actions or row in moved_in[path]):
+                kept_files += 1
+                kept_size += size
+                continue
+            file = table.path(row)
+            action = {'action': 'keep', 'subdir': period, 'file': file, 'destination': None, 'mtime': mtime, 'size': size}
+            actions.append(action)
+            if file_num < keep:
+                continue
+            if move_old_path:
+                action['destination'] = move_old_path / file.name
+                action['action'] = 'move' if reserve(action['destination']) else 'conflict'
+            elif delete_old:
+                action['action'] = 'delete'
+            else:
+                action['action'] = 'would_delete'
+    return actions, kept_files, kept_size
+
+def temp_path(destination):
+    # temporary file in the same directory, which is renamed to 'destination' when it is complete
+    destination = Path(destination)
+    return destination.with_name("{}.{}.{}.tmp".format(INTERNAL_PREFIX, os.getpid(), destination.name))
+
+class Transfers:
+    # Limits for moving files to another filesystem ('max_parallel_transfers', 'max_transfer_rate') and the process pool
+    # compressing files ('max_parallel_compressions'). They are shared by all repositories, so parallel jobs don't multiply
+    # the load on the archive volume.
+
+    def __init__(self, workers=1, rate=None, compress_workers=None):
+        self.workers = workers
+        self.rate = rate # bytes per second (None = unlimited)
+        self.slots = threading.BoundedSemaphore(workers)
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+        self.compress_workers = compress_workers # default: number of CPUs
+        self.pool = None
+
+    def compress(self, source, destination, method):
+        # Compresses a file in the process pool (started on first use). Returns a future of compress_file().
+        with self.lock:
+            if self.pool is None:
+                import multiprocessing
+                # worker processes are started fresh instead of forking this process with its threads:
+                self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.compress_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.pool.submit(compress_file, str(source), str(destination), method)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def throttle(self, size):
+        # called after 'size' bytes have been copied. Waits as long as needed to keep the rate of all transfers together:
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_time, now)
+            self.next_time = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+def transfer_file(source, destination, transfers=None):
+    # Moves a file to another filesystem. The content is copied by the kernel (copy_file_range or sendfile, if available)
+    # to a temporary name in the destination directory, written to disk and renamed into place after its size has been
+    # verified. Only then the source is deleted, so a crash never leaves a partially copied file with the final name.
+    temp = temp_path(destination)
+    method = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'sendfile' if hasattr(os, 'sendfile') else 'read'
+    with open(source, 'rb', buffering=0) as src:
+        st = os.fstat(src.fileno())
+        try:
+            with open(temp, 'wb', buffering=0) as dst:
+                offset = 0
+                while offset < st.st_size:
+                    length = min(TRANSFER_CHUNK_SIZE, st.st_size - offset)
+                    try:
+                        if method == 'copy_file_range':
+                            n = os.copy_file_range(src.fileno(), dst.fileno(), length, offset)
+                        elif method == 'sendfile':
+                            n = os.sendfile(dst.fileno(), src.fileno(), offset, length)
+                        else:
+                            os.lseek(src.fileno(), offset, os.SEEK_SET)
+                            data = memoryview(os.read(src.fileno(), length))
+                            n = len(data)
+                            while data:
+                                data = data[os.write(dst.fileno(), data):]
+                    except OSError as err:
+                        # not supported for this combination of filesystems (or by the kernel): try the next method
+                        if method != 'read' and err.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                            method = 'sendfile' if method == 'copy_file_range' and hasattr(os, 'sendfile') else 'read'
+                            continue
+                        raise
+                    if n == 0:
+                        break # source is shorter than expected, see below
+                    offset += n
+                    if transfers:
+                        transfers.throttle(n) # the kernel might copy less than requested
+                os.fsync(dst.fileno())
+                copied = os.fstat(dst.fileno()).st_size
+            after = os.fstat(src.fileno())
+            if copied != st.st_size or after.st_size != st.st_size or after.st_mtime_ns != st.st_mtime_ns:
+                raise OSError(errno.EIO, "Copy has {} bytes, but source has {} bytes or was modified during the copy".format(copied, after.st_size))
+            os.chmod(temp, stat.S_IMODE(st.st_mode))
+            os.utime(temp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.rename(temp, destination)
+        except BaseException:
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+            raise
+    os.unlink(source)
+
+def compress_file(source, destination, method):
+    # Compresses 'source' to 'destination' and deletes 'source'. Runs in a worker process of Transfers. The content is
+    # streamed, so memory usage doesn't depend on the file size. The compressed file keeps mode and mtime of the source,
+    # so it stays in the same weekly, monthly or yearly bucket. It is written to a temporary name first.
+    import shutil, importlib
+    module = importlib.import_module(method)
+    st = os.stat(source)
+    temp = temp_path(destination)
+    try:
+        with open(source, 'rb') as src, open(temp, 'wb') as raw:
+            if method == 'gzip':
+                dst = module.GzipFile(filename=os.path.basename(source), mode='wb', fileobj=raw, compresslevel=6, mtime=int(st.st_mtime))
+            elif method == 'bz2':
+                dst = module.BZ2File(raw, 'wb')
+            else:
+                dst = module.LZMAFile(raw, 'wb')
+            with dst:
+                shutil.copyfileobj(src, dst, TRANSFER_CHUNK_SIZE)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.chmod(temp, stat.S_IMODE(st.st_mode))
+        os.utime(temp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.rename(temp, destination)
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except OSError:
+            pass
+        raise
+    os.unlink(source)
+    return os.stat(destination).st_size
+
+def execute_plan(actions, alias, index, transfers=None):
+    # Executes the actions of plan_retention() in stages (base directory first, then each subdirectory). Files are moved
+    # with os.rename. Between different filesystems they are copied by transfer_file() in parallel (see 'transfers').
+    # Files moved into a directory with 'compress' are compressed by a process pool instead.
+    # Files are deleted by a pool of worker threads. The scan index is updated once per stage. Failed actions get an
+    # 'error' key. Returns the number of failed actions.
+    failed = 0
+    engine = transfers or Transfers()
+    compressed_sizes = {} # size of compressed files, they take part in the following stages
+    for subdir, stage in itertools.groupby(actions, key=lambda action: action['subdir']):
+        stage = list(stage)
+        for action in stage:
+            if action['file'] in compressed_sizes.keys():
+                action['size'] = compressed_sizes[action['file']]
+        prefix = alias if subdir is None else "{}({})".format(alias, subdir)
+        if subdir is not None:
+            logging.debug("{}: Cleaning up {} subdirectory. ".format(alias, subdir))
+        moves = [action for action in stage if action['action'] == 'move']
+        deletes = [action for action in stage if action['action'] == 'delete']
+        if failed and (moves or deletes):
+            # files of later stages might depend on the failed actions:
+            logging.error("{}: Skipping clean up because of previous errors. ".format(prefix))
+            for action in moves + deletes:
+                action['error'] = "skipped"
+            continue
+
+        for action in stage:
+            if action['action'] == 'move' and 'compress' in action.keys():
+                logging.info("{}: Moving '{}' to '{}' ({} compressed). ".format(prefix, action['file'].name, action['destination'], action['compress']))
+            elif action['action'] == 'move':
+                logging.info("{}: Moving '{}' to '{}'. ".format(prefix, action['file'].name, action['destination']))
+            elif action['action'] == 'conflict':
+                logging.error("{}: Cannot move '{}' to '{}'. Destination file already exists! ".format(prefix, action['file'].name, action['destination']))
+            elif action['action'] == 'delete':
+                logging.info("{}: Deleting '{}'. ".format(prefix, action['file'].name))
+            elif action['action'] == 'would_delete':
+                logging.info("{}: '{}' would have been deleted, but 'delete_old' is not enabled. ".format(prefix, action['file'].name))
+
+        def unlink(action):
+            try:
+                os.unlink(action['file'])
+            except OSError as err:
+                action['error'] = str(err)
+
+        def change(action):
+            # (removed, added) tuple for the scan index
+            return action['file'], (action['destination'], action['mtime'], action['size']) if action['destination'] else None
+
+        def transfer(action):
+            with engine.slots:
+                start = time.perf_counter()
+                try:
+                    transfer_file(action['file'], action['destination'], engine)
+                except OSError as err:
+                    action['error'] = str(err)
+                    return
+                duration = time.perf_counter() - start
+            logging.debug("{}: Copied '{}' to other filesystem: {} in {:.1f} s ({}/s). ".format(prefix, action['file'].name,
+                humanize_size(action['size']), duration, humanize_size(action['size'] / max(duration, 0.001))))
+
+        def execute():
+            # compression runs in the background while the other files are moved:
+            compressing = [(action, engine.compress(action['file'], action['destination'], action['compress'])) for action in moves if 'compress' in action.keys()]
+            cross_device = []
+            for action in moves:
+                if 'compress' in action.keys():
+                    continue
+                try:
+                    count('rename')
+                    os.rename(action['file'], action['destination'])
+                    count('bytes_moved', action['size'])
+                except OSError as err:
+                    if err.errno == errno.EXDEV:
+                        cross_device.append(action)
+                    else:
+                        action['error'] = str(err)
+            if cross_device:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(engine.workers, len(cross_device))) as pool:
+                    list(pool.map(transfer, cross_device))
+                for action in cross_device:
+                    if not 'error' in action.keys():
+                        count('open', 2)
+                        count('rename')
+                        count('unlink')
+                        count('bytes_moved', action['size'])
+            for action, future in compressing:
+                try:
+                    size = future.result()
+                except (OSError, concurrent.futures.process.BrokenProcessPool) as err:
+                    action['error'] = str(err)
+                    continue
+                logging.debug("{}: Compressed '{}' from {} to {}. ".format(prefix, action['file'].name, humanize_size(action['size']), humanize_size(size)))
+                count('open', 2)
+                count('rename')
+                count('unlink')
+                count('bytes_moved', action['size'])
+                action['size'] = compressed_sizes[action['destination']] = size
+            count('unlink', len(deletes))
+            if len(deletes) > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(DELETE_WORKERS, len(deletes))) as pool:
+                    list(pool.map(unlink, deletes))
+            else:
+                for action in deletes:
+                    unlink(action)
+            return [change(action) for action in moves + deletes if not 'error' in action.keys()]
+
+        index.update_batch([change(action) for action in moves + deletes], execute)
+        for action in moves + deletes:
+            if 'error' in action.keys():
+                logging.error("{}: Cannot {} '{}': {}".format(prefix, action['action'], action['file'].name, action['error']))
+                failed += 1
+    if transfers is None:
+        engine.close()
+    return failed
+
+def replace_file(source, destination, mode):
+    # Replaces 'destination' by a hardlink to 'source' or by a reflink (copy-on-write clone, FICLONE ioctl on Linux, e.g. Btrfs
+    # or XFS) of it. A reflink keeps mode, owner and mtime of 'destination'. The new file is created under a temporary name first,
+    # so 'destination' is never missing.
+    temp = temp_path(destination)
+    try:
+        if mode == 'hardlink':
+            os.link(source, temp)
+        else:
+            import fcntl
+            st = os.stat(destination)
+            with open(source, 'rb') as src, open(temp, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                temp_st = os.fstat(dst.fileno())
+            if (temp_st.st_uid, temp_st.st_gid) != (st.st_uid, st.st_gid):
+                os.chown(temp, st.st_uid, st.st_gid)
+            os.chmod(temp, stat.S_IMODE(st.st_mode))
+            os.utime(temp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.rename(temp, destination)
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except OSError:
+            pass
+        raise
+
+def dedup_files(alias, files, mode, digests, index):
+    # Replaces files with identical content by hardlinks or reflinks to one of them ('dedup'). 'files' maps the paths of all
+    # files of a repository to their size. Only files of the same size are hashed, files with the same hash are compared byte
+    # by byte before they are replaced. Hardlinks share mode, owner and mtime, so with 'hardlink' only files with the same mode
+    # and owner are linked. Files with another mtime are replaced by reflinks instead (if supported and 'state_dir' is set),
+    # so the retention isn't affected. Returns the number of replaced files, the reclaimed bytes and the number of failed
+    # replacements.
+    by_size = {}
+    for path, size in files.items():
+        if size > 0:
+            by_size.setdefault(size, []).append(path)
+    groups = {}
+    for size, paths in by_size.items():
+        if len(paths) < 2:
+            continue
+        for path in paths:
+            try:
+                count('stat')
+                st = os.stat(path)
+                digest = digests.digest(path)
+            except OSError as err:
+                logging.error("{}: Cannot calculate hash of '{}' for deduplication: {}".format(alias, path, err))
+                continue
+            # digests are calculated over the decompressed content, so compressed files are only grouped with each other:
+            key = (digest, compression_of(path), st.st_dev)
+            if mode == 'hardlink':
+                key += (stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid)
+            groups.setdefault(key, []).append((path, st))
+
+    replacements = []
+    for key, group in groups.items():
+        if len(group) < 2:
+            continue
+        digest = key[0]
+        # the file with the most links is kept, so existing hardlinks are reused:
+        group.sort(key=lambda file: (-file[1].st_nlink, str(file[0])))
+        source, source_st = group[0]
+        for path, st in group[1:]:
+            link = 'hardlink' if mode == 'hardlink' and st.st_mtime_ns == source_st.st_mtime_ns else 'reflink'
+            if st.st_ino == source_st.st_ino or (link == 'reflink' and digests.is_clone(st, digest)):
+                continue # already deduplicated
+            if link == 'reflink' and digests.db is None:
+                continue # without 'state_dir', reflinks can't be recognized again and would be replaced in every run
+            replacements.append((source, source_st, path, st, digest, link))
+
+    done = []
+    failed = []
+    unsupported = set() # devices without reflink support
+    def execute():
+        for source, source_st, path, st, digest, link in replacements:
+            if link == 'reflink' and source_st.st_dev in unsupported:
+                if mode == 'reflink':
+                    failed.append(path)
+                continue
+            try:
+                # the stored hashes might be outdated (e.g. a corrupted file with unchanged mtime), so the content is
+                # compared again right before a file is replaced:
+                if not contents_equal(source, path):
+                    logging.error("{}: '{}' and '{}' have the same stored hash, but their content differs. One of them might be corrupted, they are not deduplicated. ".format(alias, path, source))
+                    failed.append(path)
+                    continue
+                count('open', 0 if link == 'hardlink' else 2)
+                count('rename')
+                replace_file(source, path, link)
+            except OSError as err:
+                if link == 'reflink' and err.errno in (errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                    unsupported.add(source_st.st_dev)
+                    if mode == 'hardlink':
+                        logging.debug("{}: Identical files with another modification time are not deduplicated, as reflinks are not supported on the filesystem of '{}': {}".format(alias, path, err))
+                        continue
+                    logging.error("{}: Reflinks are not supported on the filesystem of '{}': {}".format(alias, path, err))
+                else:
+                    logging.error("{}: Cannot replace '{}' by a {} to '{}': {}".format(alias, path, link, source.name, err))
+                failed.append(path)
+                continue
+            logging.debug("{}: Replaced '{}' by a {} to '{}' (identical content). ".format(alias, path, link, source))
+            if link == 'reflink':
+                digests.add_clone(source_st, digest)
+                digests.add_clone(os.stat(path), digest)
+            done.append((path, st, link))
+        return [(path, (path, st.st_mtime, st.st_size)) for path, st, link in done]
+
+    if replacements:
+        index.update_batch([(path, (path, st.st_mtime, st.st_size)) for source, source_st, path, st, digest, link in replacements], execute)
+        if digests.db is not None:
+            digests.db.commit()
+    # the data of a hardlinked file is only freed if this was its last link:
+    reclaimed = sum(st.st_size for path, st, link in done if link == 'reflink' or st.st_nlink == 1)
+    return len(done), reclaimed, len(failed)
+
+def files_after_cleanup(tables, actions, scanned_after=None):
+    # Yields path (as string), size and mtime of all files of a repository after the clean up without scanning it again:
+    # the executed 'actions' of plan_retention() are applied to the scan results from before the clean up ('tables').
+    # 'scanned_after' is a table which was scanned after the clean up (like 'move_old_to'). Paths may be yielded twice,
+    # the last entry is the current one.
+    changed = {}
+    for action in actions:
+        if action['action'] == 'move' and not 'error' in action.keys():
+            changed[str(action['file'])] = None
+            changed[str(action['destination'])] = (action['size'], action['mtime'])
+        elif action['action'] == 'delete' and not 'error' in action.keys():
+            changed[str(action['file'])] = None
+        else:
+            changed[str(action['file'])] = (action['size'], action['mtime'])
+    def rows(table):
+        # same paths as str(table.path(row)), without creating Path objects:
+        prefixes = [os.path.join(directory, '') for directory in table.dirs]
+        for row in table.order:
+            yield prefixes[table.dir_nums[row]] + table.name(row), table.sizes[row], table.mtimes[row]
+    for table in tables:
+        for file in rows(table):
+            if not file[0] in changed:
+                yield file
+    for path, file in changed.items():
+        if file is not None:
+            yield path, file[0], file[1]
+    if scanned_after is not None:
+        yield from rows(scanned_after)
+
+def check_integrity(alias, db, root, pattern, files, moves, verify_runs, workers):
+    # Updates the integrity manifest of a repository ('integrity') in the state database and detects silently corrupted
+    # files. 'files' yields path, size and mtime of all files of the repository, 'moves' the (source, destination) of the
+    # files renamed by the clean up, which keep their hash. Only new files and files with a changed size or mtime are hashed.
+    # Unchanged files are verified again in a rotating sample: each run the 1/verify_runs of them which were verified longest
+    # ago, so the whole repository is covered within 'verify_runs' runs. A file is corrupted if its content changed although
+    # size and mtime didn't. Its old hash is kept and it is verified first in the next run again.
+    # The files are hashed by a pool of 'workers' threads (hashlib releases the GIL while hashing large chunks).
+    # Returns the corrupted files, the number of files which couldn't be read, the number of hashed files and bytes and the
+    # time spent hashing in seconds.
+    db.executemany("UPDATE OR REPLACE integrity SET path = ? WHERE root = ? AND pattern = ? AND path = ?",
+        ((destination, root, pattern, source) for source, destination in moves))
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS integrity_files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL)")
+    db.execute("DELETE FROM integrity_files")
+    db.executemany("INSERT OR REPLACE INTO integrity_files VALUES (?, ?, ?)", files)
+    # files which don't exist anymore:
+    db.execute("DELETE FROM integrity WHERE root = ? AND pattern = ? AND NOT path IN (SELECT path FROM integrity_files)", (root, pattern))
+    # new and changed files (without expected hash):
+    checks = db.execute("SELECT f.path, f.size, f.mtime, NULL FROM integrity_files f LEFT JOIN integrity i ON i.root = ? AND i.pattern = ? AND i.path = f.path "
+        "WHERE i.path IS NULL OR i.size != f.size OR i.mtime != f.mtime", (root, pattern)).fetchall()
+    if verify_runs:
+        total = db.execute("SELECT count(*) FROM integrity WHERE root = ? AND pattern = ?", (root, pattern)).fetchone()[0]
+        checks += db.execute("SELECT i.path, i.size, i.mtime, i.digest FROM integrity i JOIN integrity_files f ON f.path = i.path AND f.size = i.size AND f.mtime = i.mtime "
+            "WHERE i.root = ? AND i.pattern = ? ORDER BY i.verified, i.path LIMIT ?", (root, pattern, -(-total // verify_runs))).fetchall()
+    db.execute("DELETE FROM integrity_files")
+
+    def hash_path(check):
+        # small files don't need a large buffer:
+        try:
+            return hash_file(check[0], 'sha256', min(max(check[1] + 1, 65536), HASH_BUFFER_SIZE), decompress=False), None
+        except OSError as err:
+            return None, err
+
+    now = time.time()
+    corrupted = []
+    failed = 0
+    hashed = hashed_bytes = new = 0
+    seconds = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # in batches, so there are not millions of futures at once:
+        for batch_start in range(0, len(checks), 1000):
+            batch = checks[batch_start:batch_start + 1000]
+            start = time.perf_counter()
+            digests = list(pool.map(hash_path, batch))
+            seconds += time.perf_counter() - start
+            updates = []
+            verified = []
+            for (path, size, mtime, expected), (digest, err) in zip(batch, digests):
+                if err is not None:
+                    logging.error("{}: Cannot calculate hash of '{}' for the integrity check: {}".format(alias, path, err))
+                    failed += 1
+                    continue
+                count('open')
+                count('bytes_read', size)
+                hashed += 1
+                hashed_bytes += size
+                if expected is None:
+                    updates.append((root, pattern, path, size, mtime, digest, now))
+                elif digest != expected:
+                    logging.critical("{}: Content of '{}' changed, although its size and modification time are unchanged (SHA-256 {} instead of {}). The file might be corrupted! ".format(alias, path, digest, expected))
+                    corrupted.append(path)
+                    verified.append((0, root, pattern, path))
+                else:
+                    verified.append((now, root, pattern, path))
+            db.executemany("INSERT OR REPLACE INTO integrity VALUES (?, ?, ?, ?, ?, ?, ?)", updates)
+            db.executemany("UPDATE integrity SET verified = ? WHERE root = ? AND pattern = ? AND path = ?", verified)
+            new += len(updates)
+    db.commit()
+    logging.debug("{}: Hashed {} new or changed file{} and verified {} file{} of the integrity manifest ({} in {:.1f} s). ".format(alias,
+        new, "" if new == 1 else "s", hashed - new, "" if hashed - new == 1 else "s", humanize_size(hashed_bytes), seconds))
+    return corrupted, failed, hashed, hashed_bytes, seconds
+
+def process_repo(repo, pull_future=None, state_dir=None, compliance_rules=None, config_errors=(), transfers=None):
+    # Runs the pipeline (wait for pull, scan, checks, compare, retention) for a single repository and returns its
+    # report fragment, perfdata and totals. Repositories don't share any state, so this can run in a worker thread.
+    metrics = repo_metrics.counters = {} # collected by count() and timed() in this thread
+    current_dir = Path(repo['directory'])
+    subdir_paths = {} # existing weekly, monthly and yearly directories in the order they are cleaned up
+
+    dir_files = 0
+    dir_size = 0
+    files_deleted = 0
+    newest_file_deleted = 0
+    compliance_violations = 0
+    newest_file = None
+    lines_added = lines_removed = None
+    files_deduplicated = bytes_reclaimed = None
+    files_hashed = bytes_hashed = hash_seconds = files_corrupted = None
+    plan = [] # planned file operations if PLAN_ONLY is set
+    newest_file_size = 0
+    newest_file_mtime = datetime.datetime.fromtimestamp(0)
+    scan_time = None # start of the scan of the base directory (used by watch mode)
+    newest_file_age = datetime.datetime.now() - newest_file_mtime
+    yearly_path = monthly_path = weekly_path = move_old_path = None
+    pattern_segments = compile_pattern(repo['pattern'], compressed_extensions(repo))
+    max_file_size = int(repo['max_file_size']) if 'max_file_size' in repo.keys() else MAX_FILE_SIZE_FOR_COMPLIANCE_CHECK
+    # optional persistent index of scanned directories:
+    state_db = open_state_db(state_dir) if state_dir is not None else None
+    if state_db is not None and 'scan_index' in repo.keys() and repo['scan_index']:
+        index = ScanIndex(state_db, REBUILD_INDEX)
+    else:
+        index = ScanIndex()
+    digests = DigestStore(state_db)
+    # scan results of the weekly, monthly and yearly directories. They are shared by the bucket detection and the clean up below:
+    subdir_files: dict[Path, FileTable] = {}
+
+    report_string = ""
+    perfdata_array = []
+    warn_str = ""
+    crit_str = ""
+    
+    # Files in the directory with their modification time and size, sorted by modification time (see FileTable):
+    file_table = FileTable()
+    # With --check-only or if there is nothing to clean up (no 'keep' and no weekly, monthly or yearly directories), only the
+    # two newest files are kept while scanning (see scan_newest). Subdirectories are not scanned and retention is skipped:
+    check_only = CHECK_ONLY or (not PLAN_ONLY and not any(key in repo.keys() for key in ('keep', 'weekly', 'monthly', 'yearly'))
+        and not any(key in repo.keys() and repo[key] for key in ('scan_index', 'dedup', 'integrity')))
+    total_files = total_size = 0 # number and size of all matching files in the base directory (only counted if check_only is set)
+
+    alias = repo_alias(repo)
+
+    # errors found while validating the config (like invalid regexes). The repository is not processed at all:
+    if config_errors:
+        for log in config_errors:
+            logging.error(alias + ": " + log)
+            crit_str += log
+        if state_db is not None:
+            state_db.close()
+        return {'report': "\n[CRITICAL] " + crit_str, 'perfdata': [], 'crit_str': crit_str, 'warn_str': "",
+                'exitcode': 2, 'size': 0, 'files': 0, 'deleted': 0, 'plan': plan, 'newest_mtime': None, 'scan_time': scan_time,
+                'metrics': metrics}
+
+    if not current_dir.is_dir():
+        crit_str += "Directory '{}' not found. ".format(current_dir)
+        logging.error(alias + ": " + crit_str)
+    else:
+        # wait for the pull command of this repository (started up front in main()):
+        if pull_future is not None:
+            count('pull_ms', pull_future.result())
+
+        scan_time = time.time()
+        with timed('scan_ms'):
+            if check_only:
+                file_table, total_files, total_size = scan_newest(current_dir, pattern_segments)
+            else:
+                file_table = index.scan_directory(current_dir, repo['pattern'], pattern_segments)
+        logging.debug("{}: Found {} matching backup files in Directory '{}'. ".format(alias, total_files if check_only else len(file_table), current_dir))
+
+    if 'weekly' in repo.keys() and 'directory' in repo['weekly'].keys() and not CHECK_ONLY:
+        weekly_path = current_dir / Path(repo['weekly']['directory']) # if weekly path is absolute already, current_dir will be ignored
+        if not weekly_path.is_dir():
+            log = "Weekly directory '{}' does not exist. Please create the directory. ".format(weekly_path)
+            logging.error(alias + ": " + log)
+            crit_str += log
+            weekly_path = None
+        else:
+            if not weekly_path in subdir_files.keys():
+                with timed('scan_ms'):
+                    subdir_files[weekly_path] = index.scan_directory(weekly_path, repo['pattern'], pattern_segments)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("{}: Found weekly directory '{}' with files from the following weeks: {}. ".format(alias, weekly_path, sorted(set(bucket_key(subdir_files[weekly_path].mtimes[row], 'weekly') for row in subdir_files[weekly_path].order))))
+            subdir_paths['weekly'] = weekly_path
+
+    if 'monthly' in repo.keys() and 'directory' in repo['monthly'].keys() and not CHECK_ONLY:
+        monthly_path = current_dir / Path(repo['monthly']['directory'])
+        if not monthly_path.is_dir():
+            log = "Monthly directory '{}' does not exist. Please create the directory. ".format(monthly_path)
+            logging.error(alias + ": " + log)
+            crit_str += log
+            monthly_path = None
+        else:
+            if not monthly_path in subdir_files.keys():
+                with timed('scan_ms'):
+                    subdir_files[monthly_path] = index.scan_directory(monthly_path, repo['pattern'], pattern_segments)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("{}: Found monthly directory '{}' with files from the following months: {}. ".format(alias, monthly_path, sorted(set(bucket_key(subdir_files[monthly_path].mtimes[row], 'monthly') for row in subdir_files[monthly_path].order))))
+            subdir_paths['monthly'] = monthly_path
+
+    if 'yearly' in repo.keys() and 'directory' in repo['yearly'].keys() and not CHECK_ONLY:
+        yearly_path = current_dir / Path(repo['yearly']['directory'])
+        if not yearly_path.is_dir():
+            log = "Yearly directory '{}' does not exist. Please create the directory. ".format(yearly_path)
+            logging.error(alias + ": " + log)
+            crit_str += log
+            yearly_path = None
+        else:
+            if not yearly_path in subdir_files.keys():
+                with timed('scan_ms'):
+                    subdir_files[yearly_path] = index.scan_directory(yearly_path, repo['pattern'], pattern_segments)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("{}: Found yearly directory '{}' with files from the following years: {}. ".format(alias, yearly_path, sorted(set(bucket_key(subdir_files[yearly_path].mtimes[row], 'yearly') for row in subdir_files[yearly_path].order))))
+            subdir_paths['yearly'] = yearly_path
+
+    if 'move_old_to' in repo.keys():
+        move_old_path = current_dir / Path(repo['move_old_to'])
+        if not move_old_path.is_dir():
+            log = "'move_old_to' directory '{}' does not exist. Please create the directory. ".format(move_old_path)
+            logging.error(alias + ": " + log)
+            crit_str += log
+            move_old_path = None
+
+    if crit_str:
+        if state_db is not None:
+            state_db.close()
+        return {'report': "\n[CRITICAL] " + crit_str, 'perfdata': [], 'crit_str': crit_str, 'warn_str': "",
+                'exitcode': 2, 'size': 0, 'files': 0, 'deleted': 0, 'plan': plan, 'newest_mtime': None, 'scan_time': scan_time,
+                'metrics': metrics}
+
+    if len(file_table) == 0:
+        log = "Directory '{}' does not contain any file matching the pattern '{}'. ".format(current_dir, repo['pattern'])
+        logging.warning(alias + ": " + log)
+        warn_str += log
+        #continue
+    else: 
+        # check newest file in the directory:
+        newest_row = file_table.order[-1]
+        newest_file = file_table.path(newest_row)
+        newest_file_size = file_table.sizes[newest_row]
+        newest_file_mtime = datetime.datetime.fromtimestamp(file_table.mtimes[newest_row])
+        newest_file_age = datetime.datetime.now() - newest_file_mtime
+
+        logging.debug("{}: '{}' is the newest file in the directory. ".format(alias, newest_file))
+
+        # check age of newest file:
+        if 'warn_age' in repo.keys() and newest_file_age > datetime.timedelta(days = repo['warn_age']):
+            log = "Newest file '{}' is older than defined warn_age (Age: {}, warn_age: {} day{}). ".format(
+                newest_file.name, newest_file_age.days, repo['warn_age'], "" if repo['warn_age'] == 1 else "s"
+            )
+            logging.warning(alias + ": " + log)
+            warn_str += log
+
+        # check size of newest file:
+        if 'warn_bytes' in repo.keys() and newest_file_size < repo['warn_bytes']:
+            log = "Newest file '{}' is smaller than defined warn_bytes (Size: {}, warn_bytes: {} bytes). ".format(
+                newest_file.name, humanize_size(newest_file_size), repo['warn_bytes']
+            )
+            logging.warning(alias + ": " + log)
+            warn_str += log
+
+        # check newest file for compliance:
+        if 'compliance_check' in repo.keys():
+            rule_set = compliance_rules
+            # line based rules stream over the memory map, so 'max_file_size' only limits the rules which search the whole
+            # decoded content (and compressed files, which are decompressed into memory, see map_file):
+            if newest_file_size > max_file_size and compression_of(newest_file) is None:
+                skipped = [rule for rule in compliance_rules['rules'] if not rule['line_based']]
+                for rule in skipped:
+                    logging.error("{}: Content of '{}' can't be checked for compliance with regex '{}': The regex can match across lines and the file exceeds 'max_file_size' ({}). ".format(alias, newest_file, rule['regex'], humanize_size(max_file_size)))
+                if skipped:
+                    warn_str += "Content of '{}' can't be loaded for compliance checking. See log file for more details. ".format(newest_file.name)
+                rule_set = {'rules': [rule for rule in compliance_rules['rules'] if rule['line_based']], 'prefilter': compliance_rules['prefilter']}
+            if rule_set['rules']:
+                logging.debug("{}: Checking content of file '{}' for compliance. ".format(alias, newest_file))
+                # all checks are applied to the same memory map of the file (compressed files are decompressed into memory):
+                rule_times = []
+                try:
+                    with timed('compliance_ms'), map_file(newest_file, max_file_size) as newest_file_map:
+                        results, rule_times = run_compliance_checks(rule_set, newest_file_map)
+                        for rule, match in results:
+                            if (match and rule['must_not_match']) or (not match and not rule['must_not_match']):
+                                # compliance violation:
+                                compliance_violations += 1
+                                if rule['violation_message'] is not None:
+                                    log = "Compliance violation in file '{}': {} ".format(newest_file.name, match.expand(rule['violation_message']) if match else rule['violation_message'])
+                                else:
+                                    log = "Compliance violation in file '{}': Does {}match regex '{}'. ".format(newest_file.name, "" if match else "not ", rule['regex'])
+                                logging.critical(alias + ": " + log)
+                                crit_str += log
+                            else:
+                                # compliant
+                                logging.debug("{}: Newest file '{}' is compliant with regex '{}'. ".format(alias, newest_file.name, rule['regex']))
+                except (OSError, ValueError) as err:
+                    logging.error("{}: Content of '{}' can't be checked for compliance: {} ".format(alias, newest_file, err))
+                    warn_str += "Content of '{}' can't be loaded for compliance checking. See log file for more details. ".format(newest_file.name)
+                for rule, seconds in sorted(zip(rule_set['rules'], rule_times), key=lambda rule_time: rule_time[1], reverse=True):
+                    logging.debug("{}: Compliance check with regex '{}' took {:.1f} ms. ".format(alias, rule['regex'], seconds * 1000))
+
+    # compare newest file with previous file:
+    if 'compare_with_previous' in repo.keys() and newest_file and len(file_table) >= 2:
+        comp_cfg = repo['compare_with_previous']
+
+        previous_file = file_table.path(file_table.order[-2])
+        previous_file_mtime = datetime.datetime.fromtimestamp(file_table.mtimes[file_table.order[-2]])
+
+        ignore_changes = False
+
+        with timed('compare_ms'):
+            file_changed = not digests.files_equal(previous_file, newest_file)
+        if not file_changed:
+            # files are the same:
+            if 'warn_age_limit' in comp_cfg.keys() and newest_file_age > datetime.timedelta(days = comp_cfg['warn_age_limit']):
+                logging.debug("{}: Newest file '{}' equals previous file and is older than defined 'warn_age_limit' for comparison. ".format(alias, newest_file.name))
+            else:
+                log = "Content of newest file '{}' equals content of previous file '{}'. ".format(newest_file.name, previous_file.name)
+                if 'warn_if_equal' in comp_cfg.keys() and comp_cfg['warn_if_equal']:
+                    logging.warning(alias + ": " + log)
+                    warn_str += log
+                else:
+                    logging.info(alias + ": " + log)
+
+        else: # newest file is different than previous:
+            if 'warn_age_limit' in comp_cfg.keys() and newest_file_age > datetime.timedelta(days = comp_cfg['warn_age_limit']):
+                logging.debug("{}: Newest file '{}' has changed compared to previous file and is older than defined 'warn_age_limit' for comparison. ".format(alias, newest_file.name))
+            else:
+                log = "Newest file '{}' has changed compared to previous file '{}'. ".format(newest_file.name, previous_file.name)
+                
+                # check if changes are ignored by 'ignore_regex':
+                if 'ignore_regex' in comp_cfg.keys():
+                    ignore_pattern = re.compile(comp_cfg['ignore_regex'], flags=re.MULTILINE)
+                    try:
+                        with timed('compare_ms'):
+                            ignore_changes = digests.normalized_files_equal(previous_file, newest_file, ignore_pattern, max_file_size)
+                    except (OSError, ValueError) as err:
+                        log_err = "'ignore_regex' for comparison can't be applied. "
+                        warn_str += (log_err + "See log file for details. ")
+                        logging.error(alias + ": " + log_err + str(err))
+                
+                if 'warn_if_changed' in comp_cfg.keys() and comp_cfg['warn_if_changed'] and not ignore_changes:
+                    logging.warning(alias + ": " + log)
+                    warn_str += log
+                elif ignore_changes:
+                    logging.info(alias + ": " + log + "All changes are ignored because of 'ignore_regex'. ")
+                else:
+                    logging.info(alias + ": " + log)
+
+                # log diff:
+                if 'log_diff' in comp_cfg and comp_cfg['log_diff'] and not ignore_changes:
+                    max_diff_lines = int(comp_cfg['max_diff_lines']) if 'max_diff_lines' in comp_cfg.keys() else MAX_DIFF_LINES
+                    try:
+                        with timed('compare_ms'):
+                            lines_added, lines_removed = log_diff(alias, previous_file, newest_file,
+                                "{}\t{}".format(previous_file.name, previous_file_mtime.isoformat()),
+                                "{}\t{}".format(newest_file.name, newest_file_mtime.isoformat()),
+                                max_diff_lines)
+                    except (OSError, ValueError) as err:
+                        log_err = "Differences between '{}' and '{}' cannot be logged. ".format(newest_file.name, previous_file.name)
+                        warn_str += (log_err + "See log file for details. ")
+                        logging.error(alias + ": " + log_err + "Note: Diff log only works for text files! " + str(err))
+
+        # delete newest file if delete_if_equal is set and there are no changes or the changes are ignored because of ignore_regex
+        if 'delete_if_equal' in comp_cfg.keys() and comp_cfg['delete_if_equal'] and not CHECK_ONLY and ( not file_changed or (ignore_changes and 'delete_if_ignored' in comp_cfg.keys() and comp_cfg['delete_if_ignored']) ):
+            if file_changed:
+                logging.info("{}: Deleting '{}' because all changes are ignored by 'ignore_regex' and 'delete_if_ignored' is set to true. ".format(alias, newest_file.name))
+            else:
+                logging.info("{}: Deleting '{}' because it is the same as the previous file. ".format(alias, newest_file.name))
+            if PLAN_ONLY:
+                plan.append({'action': 'delete', 'subdir': None, 'file': newest_file, 'destination': None, 'mtime': file_table.mtimes[newest_row], 'size': newest_file_size})
+            else:
+                count('unlink')
+                index.update(newest_file.unlink, removed=newest_file)
+            newest_file_deleted += 1
+            del file_table.order[-1]
+
+
+    # clean up old files:
+    if check_only:
+        # all files are still in place (except a deleted newest file):
+        actions = []
+        failed = 0
+        dir_files = total_files - newest_file_deleted
+        dir_size = total_size - (newest_file_size if newest_file_deleted else 0)
+    else:
+        with timed('retention_ms'):
+            actions, dir_files, dir_size = plan_retention(repo, file_table, subdir_paths, move_old_path, subdir_files, pattern_segments, keep_actions=PLAN_ONLY)
+            failed = 0 if PLAN_ONLY else execute_plan(actions, alias, index, transfers)
+    if PLAN_ONLY:
+        plan += actions
+    elif failed:
+        log = "{} file operation{} failed during clean up. ".format(failed, "" if failed == 1 else "s")
+        warn_str += (log + "See log file for details. ")
+
+    for action in actions:
+        if action['action'] == 'delete' and not 'error' in action.keys():
+            files_deleted += 1
+        elif action['action'] in ('keep', 'would_delete') or 'error' in action.keys():
+            # files which are still in place:
+            dir_size+=action['size']
+            dir_files+=1
+
+    move_old_table = None # scan result of 'move_old_to' after the clean up, used by dedup and the integrity check
+
+    # replace files with identical content in the repository and its subdirectories by hardlinks or reflinks:
+    if 'dedup' in repo.keys() and repo['dedup'] and not PLAN_ONLY and not check_only:
+        if repo['dedup'] == 'reflink' and state_db is None:
+            log = "'dedup: reflink' requires 'state_dir' to remember which files are already deduplicated. "
+            logging.error(alias + ": " + log)
+            warn_str += log
+        else:
+            # files after the clean up (moved files are found at their destination). Only files of a size which occurs
+            # more than once can have duplicates, so Path objects are only created for them:
+            tables = [file_table] + list(subdir_files.values())
+            if move_old_path:
+                with timed('scan_ms'):
+                    move_old_table = index.scan_directory(move_old_path, repo['pattern'], pattern_segments)
+                tables.append(move_old_table)
+            sizes = collections.Counter(action['size'] for action in actions if action['action'] == 'move')
+            for table in tables:
+                sizes.update(map(table.sizes.__getitem__, table.order))
+            files = {}
+            for table in tables[:-1] if move_old_path else tables:
+                files.update((table.path(row), table.sizes[row]) for row in table.order if sizes[table.sizes[row]] > 1)
+            for action in actions:
+                if action['action'] == 'move' and not 'error' in action.keys():
+                    files.pop(action['file'], None)
+                    files[action['destination']] = action['size']
+                elif action['action'] == 'delete' and not 'error' in action.keys():
+                    files.pop(action['file'], None)
+                else:
+                    files[action['file']] = action['size']
+            if move_old_path:
+                for row in tables[-1].order:
+                    if sizes[tables[-1].sizes[row]] > 1:
+                        files.setdefault(tables[-1].path(row), tables[-1].sizes[row])
+            with timed('dedup_ms'):
+                files_deduplicated, bytes_reclaimed, failed = dedup_files(alias, files, repo['dedup'], digests, index)
+            if failed:
+                log = "{} duplicate file{} could not be replaced by {}s. ".format(failed, "" if failed == 1 else "s", repo['dedup'])
+                warn_str += (log + "See log file for details. ")
+            if files_deduplicated:
+                logging.info("{}: Replaced {} file{} with identical content by {}s. {} reclaimed. ".format(alias, files_deduplicated,
+                    "" if files_deduplicated == 1 else "s", repo['dedup'], humanize_size(bytes_reclaimed)))
+
+    # hash new files for the integrity manifest and verify a sample of the older ones again:
+    # (not if the base directory is missing, e.g. not mounted, as all files would be removed from the manifest):
+    if 'integrity' in repo.keys() and repo['integrity'] and not PLAN_ONLY and not check_only and current_dir.is_dir():
+        if state_db is None:
+            log = "'integrity' requires 'state_dir' to store the hashes of the files. "
+            logging.error(alias + ": " + log)
+            warn_str += log
+        else:
+            integrity_cfg = repo['integrity'] if type(repo['integrity']) is dict else {}
+            verify_runs = int(integrity_cfg['verify_runs']) if 'verify_runs' in integrity_cfg.keys() else INTEGRITY_VERIFY_RUNS
+            workers = int(integrity_cfg['workers']) if 'workers' in integrity_cfg.keys() else INTEGRITY_WORKERS
+            if move_old_path and move_old_table is None:
+                with timed('scan_ms'):
+                    move_old_table = index.scan_directory(move_old_path, repo['pattern'], pattern_segments)
+            # renamed files keep their hash, compressed files are new files:
+            moves = [(str(action['file']), str(action['destination'])) for action in actions
+                if action['action'] == 'move' and not 'error' in action.keys() and not 'compress' in action.keys()]
+            with timed('integrity_ms'):
+                corrupted, failed, files_hashed, bytes_hashed, hash_seconds = check_integrity(alias, state_db, str(current_dir), repo['pattern'],
+                    files_after_cleanup([file_table] + list(subdir_files.values()), actions, move_old_table), moves, verify_runs, workers)
+            files_corrupted = len(corrupted)
+            if corrupted:
+                log = "Integrity check failed for {} file{}: {}. ".format(len(corrupted), "" if len(corrupted) == 1 else "s",
+                    ", ".join("'{}'".format(Path(path).name) for path in corrupted[:10]) + (", ..." if len(corrupted) > 10 else ""))
+                crit_str += (log + "See log file for details. ")
+            if failed:
+                log = "{} file{} could not be hashed for the integrity check. ".format(failed, "" if failed == 1 else "s")
+                warn_str += (log + "See log file for details. ")
+
+    if state_db is not None:
+        digests.expire()
+        state_db.close()
+
+    # Reporting + perfdata:
+    if crit_str:
+        exitcode = 2
+        report_string += "\n[CRITICAL] "
+    elif warn_str:
+        exitcode = 1
+        report_string += "\n[WARNING] "
+    else:
+        exitcode = 0
+        report_string += "\n[OK] "
+
+    report_string += alias + ": " + crit_str + warn_str
+    report_string += "Repository contains {} matching file{} with {}. ".format(dir_files, "" if dir_files == 1 else "s", humanize_size(dir_size) )
+    if newest_file:
+        if newest_file_deleted:
+            report_string += "Newest file was {} day{} old ".format(newest_file_age.days, "" if newest_file_age.days == 1 else "s")
+            report_string += "and was deleted, because there were no relevant changes. "
+        else:
+            report_string += "Newest file is {} day{} old. ".format(newest_file_age.days, "" if newest_file_age.days == 1 else "s")
+    report_string += "{} old file{} deleted. ".format(files_deleted, "" if files_deleted == 1 else "s")
+    if compliance_violations == 0 and 'compliance_check' in repo.keys():
+        report_string += "No compliance violations. "
+    if lines_added is not None:
+        report_string += "{} line{} added and {} line{} removed in newest file. ".format(lines_added, "" if lines_added == 1 else "s", lines_removed, "" if lines_removed == 1 else "s")
+    if files_deduplicated:
+        report_string += "{} duplicate file{} replaced by {}s, {} reclaimed. ".format(files_deduplicated, "" if files_deduplicated == 1 else "s", repo['dedup'], humanize_size(bytes_reclaimed))
+
+    alias = alias.replace(" ","_")
+    perfdata_array.append("{}_files={}".format(alias, dir_files))
+    perfdata_array.append("{}_size={}b".format(alias, dir_size))
+    if newest_file:
+        perfdata_array.append("{}_age={}{}".format(alias, newest_file_age.days, (";" + str(repo['warn_age'])) if 'warn_age' in repo.keys() else ""))
+        perfdata_array.append("{}_deleted={}".format(alias, files_deleted + newest_file_deleted))
+    if lines_added is not None:
+        perfdata_array.append("{}_lines_added={}".format(alias, lines_added))
+        perfdata_array.append("{}_lines_removed={}".format(alias, lines_removed))
+    if bytes_reclaimed is not None:
+        perfdata_array.append("{}_reclaimed={}b".format(alias, bytes_reclaimed))
+    if files_hashed is not None:
+        perfdata_array.append("{}_corrupted={}".format(alias, files_corrupted))
+        perfdata_array.append("{}_hashed={}b".format(alias, bytes_hashed))
+        # bytes per second:
+        perfdata_array.append("{}_hash_throughput={:.0f}".format(alias, bytes_hashed / hash_seconds if hash_seconds else 0))
+    if 'perfdata_metrics' in repo.keys() and repo['perfdata_metrics']:
+        for phase in PHASES:
+            perfdata_array.append("{}_{}_ms={:.0f}ms".format(alias, phase, metrics.get(phase + '_ms', 0)))
+        perfdata_array.append("{}_bytes_read={}b".format(alias, metrics.get('bytes_read', 0)))
+        perfdata_array.append("{}_bytes_moved={}b".format(alias, metrics.get('bytes_moved', 0)))
+        perfdata_array.append("{}_syscalls={}".format(alias, sum(metrics.get(name, 0) for name in SYSCALLS)))
+
+    return {'report': report_string, 'perfdata': perfdata_array, 'crit_str': crit_str, 'warn_str': warn_str,
+            'exitcode': exitcode, 'size': dir_size, 'files': dir_files, 'deleted': files_deleted + newest_file_deleted, 'plan': plan,
+            'newest_mtime': newest_file_mtime.timestamp() if newest_file else None, 'scan_time': scan_time, 'metrics': metrics}
+
+
+class RepoLock:
+    # Advisory lock (fcntl) on a file in the base directory of a repository, so overlapping runs (from cron or from other
+    # shards on a shared filesystem) skip a repository instead of moving and deleting the same files at the same time.
+    # The lock file is never deleted, otherwise two runs could lock two different files. It contains the host and pid of
+    # the last run holding the lock.
+
+    WINDOWS_LOCK_OFFSET = 1048576 # without fcntl (Windows), a byte behind the content is locked with msvcrt, so the content stays readable
+
+    def __init__(self, directory):
+        self.file = Path(directory) / LOCK_FILE
+        self.fd = None
+        self.msvcrt = None
+
+    def acquire(self):
+        # Returns False if another process holds the lock. fcntl locks also work on NFS (if the server supports locking).
+        import socket
+        self.fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                import fcntl
+            except ImportError:
+                import msvcrt
+                os.lseek(self.fd, self.WINDOWS_LOCK_OFFSET, os.SEEK_SET)
+                msvcrt.locking(self.fd, msvcrt.LK_NBLCK, 1)
+                self.msvcrt = msvcrt
+            else:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as err:
+            os.close(self.fd)
+            self.fd = None
+            if err.errno in (errno.EACCES, errno.EAGAIN, errno.EDEADLOCK):
+                return False
+            raise
+        content = json.dumps({'host': socket.gethostname(), 'pid': os.getpid(), 'time': datetime.datetime.now().isoformat()}).encode()
+        try:
+            os.ftruncate(self.fd, 0)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            os.write(self.fd, content)
+        except OSError as err:
+            logging.debug("Lock file '{}' can't be written: {}".format(self.file, err)) # only informational
+        return True
+
+    def holder(self):
+        # the run holding the lock (it might just be writing the lock file)
+        try:
+            with open(self.file) as f:
+                info = json.load(f)
+            return "pid {} on {} since {}".format(info['pid'], info['host'], info['time'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return "unknown process"
+
+    def release(self):
+        try:
+            if self.msvcrt is not None:
+                os.lseek(self.fd, self.WINDOWS_LOCK_OFFSET, os.SEEK_SET)
+                self.msvcrt.locking(self.fd, self.msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self.fd) # releases the lock
+            self.fd = None
+
+def load_durations(metrics_file):
+    # processing time of each repository (sum of all phases) in the last run, from the metrics file
+    try:
+        with open(metrics_file) as f:
+            repositories = json.load(f)['repositories']
+    except (OSError, ValueError, KeyError) as err:
+        logging.debug("Durations of the last run can't be loaded from metrics file '{}': {}".format(metrics_file, err))
+        return {}
+    # repositories which were skipped in the last run have no phases:
+    return dict(((repo['alias'], str(repo['directory'])), sum(repo['metrics'].get(phase + '_ms', 0) for phase in PHASES))
+        for repo in repositories if any(phase + '_ms' in repo['metrics'].keys() for phase in PHASES))
+
+def shard_repositories(repos, shard, shards, durations=None):
+    # Deterministically selects the repositories of shard number 'shard' (1 to 'shards'), so several nodes with the same
+    # config process disjoint parts of it. By default each repository is assigned by a hash of its alias, so adding or
+    # removing a repository doesn't move the others to another shard. With 'durations' of the last run, the shards are
+    # balanced instead: repositories are assigned from the longest to the shortest to the shard with the lowest total so
+    # far. Repositories without a duration count as average.
+    if durations is not None:
+        known = [durations[key] for key in ((repo_alias(repo), str(repo['directory'])) for repo in repos) if key in durations.keys()]
+        average = sum(known) / len(known) if known else 1
+        weights = [durations.get((repo_alias(repo), str(repo['directory'])), average) for repo in repos]
+        loads = [0] * shards
+        selected = []
+        for num in sorted(range(len(repos)), key=lambda num: (-weights[num], repo_alias(repos[num]), num)):
+            target = loads.index(min(loads))
+            loads[target] += weights[num]
+            if target == shard - 1:
+                selected.append(num)
+        return [repos[num] for num in sorted(selected)]
+    return [repo for repo in repos if int.from_bytes(hashlib.sha256(repo_alias(repo).encode()).digest()[:8], 'big') % shards == shard - 1]
+
+def skipped_result(repo, exitcode, log):
+    # result of a repository which wasn't processed by this run
+    alias = repo_alias(repo)
+    return {'report': "\n[{}] {}: {}".format(["OK", "WARNING", "CRITICAL"][exitcode], alias, log), 'perfdata': [],
+            'crit_str': log if exitcode == 2 else "", 'warn_str': log if exitcode == 1 else "",
+            'exitcode': exitcode, 'size': 0, 'files': 0, 'deleted': 0, 'plan': [], 'newest_mtime': None, 'scan_time': None,
+            'metrics': {}, 'skipped': True}
+
+def run_repositories(repos, jobs, state_dir, compliance_rules, config_errors, max_pulls, max_pulls_per_host=None, pulling=None, transfers=None):
+    # Executes the pull commands and processes the given repositories. 'pulling' contains the repositories whose pull command
+    # is executed (default: all repositories with a pull command). Returns the results in the order of 'repos'.
+
+    # lock the base directories before any pull command is started. Repositories locked by another run are skipped.
+    # The locks are held until all repositories are processed, as repositories can share a base directory:
+    locks = {}
+    locked = {}
+    if not PLAN_ONLY and not CHECK_ONLY:
+        for repo in repos:
+            directory = str(Path(repo['directory']))
+            if directory in locks.keys() or directory in locked.keys() or not Path(directory).is_dir():
+                continue
+            lock = RepoLock(directory)
+            try:
+                if lock.acquire():
+                    locks[directory] = lock
+                else:
+                    locked[directory] = lock.holder()
+            except OSError as err:
+                logging.warning("{}: Cannot lock the repository, processing it without lock: {}".format(repo_alias(repo), err))
+
+    def process(repo):
+        directory = str(Path(repo['directory']))
+        if directory in locked.keys():
+            log = "Repository is locked by another run ({}). Skipped. ".format(locked[directory])
+            logging.warning(repo_alias(repo) + ": " + log)
+            return skipped_result(repo, 1, log)
+        return process_repo(repo, pull_futures.get(id(repo)), state_dir, compliance_rules.get(id(repo)), config_errors.get(id(repo), ()), transfers)
+
+    # start all pull commands up front. Each repository waits only for its own pull before it is processed.
+    # The number of simultaneous pulls is limited globally and optionally per host ('host' in pull config):
+    pull_slots = threading.BoundedSemaphore(max_pulls)
+    host_slots = {}
+    pull_futures = {}
+    pulling_repos = [repo for repo in (repos if pulling is None else pulling) if 'pull' in repo.keys() and 'command' in repo['pull'].keys() and Path(repo['directory']).is_dir() and not config_errors.get(id(repo))
+        and not str(Path(repo['directory'])) in locked.keys()]
+    for repo in pulling_repos:
+        if 'host' in repo['pull'].keys() and max_pulls_per_host and not repo['pull']['host'] in host_slots.keys():
+            host_slots[repo['pull']['host']] = threading.BoundedSemaphore(max_pulls_per_host)
+
+    try:
+        # more threads than global slots would only wait for a slot:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(len(pulling_repos), max_pulls), 1)) as pull_executor:
+            for repo in pulling_repos:
+                pull_futures[id(repo)] = pull_executor.submit(run_pull, repo, pull_slots, host_slots)
+
+            if jobs > 1 and len(repos) > 1:
+                logging.debug("Processing {} backup repositories with {} parallel jobs. ".format(len(repos), jobs))
+                with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                    # executor.map returns the results in config order, no matter which repository finished first:
+                    return list(executor.map(process, repos))
+            else:
+                return [process(repo) for repo in repos]
+    finally:
+        for lock in locks.values():
+            lock.release()
+
+def build_report(backup_repo, results):
+    # Combines the results of all repositories to the exit code, the report and the perfdata string.
+    total_size = 0
+    total_files = 0
+    total_files_deleted = 0
+
+    report_string = ""
+    summary_crit_str = ""
+    summary_warn_str = ""
+    perfdata_array = []
+
+    warn_flag = False
+    crit_flag = False
+
+    for result in results:
+        report_string += result['report']
+        perfdata_array += result['perfdata']
+
+        if result['exitcode'] == 2:
+            crit_flag = True
+        elif result['exitcode'] == 1:
+            warn_flag = True
+
+        total_size+=result['size']
+        total_files+=result['files']
+        total_files_deleted+=result['deleted']
+
+        # comment out the following 2 lines, if you dont't want all critical and warning strings of individual repositories to also be displayed in the report summary (first line of report string)
+        summary_crit_str += result['crit_str']
+        summary_warn_str += result['warn_str']
+
+    report_summary = summary_crit_str + summary_warn_str
+    report_summary += "Total {} matching file{} with {} in {} backup repositor{}. {} file{} deleted. ".format(
+        total_files, "" if total_files == 1 else "s", humanize_size(total_size), len(backup_repo), "y" if len(backup_repo) == 1 else "ies",
+        total_files_deleted, "" if total_files_deleted == 1 else "s"
+    )
+
+    report_string = report_summary + report_string
+
+    perfdata_array.append("total_files={}".format(total_files))
+    perfdata_array.append("total_size={}b".format(total_size))
+    perfdata_array.append("total_deleted={}".format(total_files_deleted))
+
+    perfdata_string = ""
+    for perfdata in perfdata_array:
+        perfdata_string += perfdata + " "
+
+    if crit_flag: exitcode = 2
+    elif warn_flag: exitcode = 1
+    else: exitcode = 0
+
+    return exitcode, report_string, perfdata_string
+
+def run_reporting_command(reporting_config, exitcode, report_string, perfdata_string):
+    # report_string contains all the relevant information in human readable form which can be sent by mail or to a monitoring system.
+    # perfdata_string contains statistics separated by spaces.
+    import subprocess, shlex
+    exitstatus_string = ["OK","WARNING","CRITICAL"][exitcode]
+
+    if 'command' in reporting_config.keys():
+        # escape variables:
+        escaped_report_string     = shlex.quote(report_string)
+        escaped_perfdata_string   = shlex.quote(perfdata_string)
+        # replace variables in command:
+        command = datetime.datetime.now().strftime(reporting_config['command']).format(
+            exitcode   = str(exitcode),
+            exitstatus = exitstatus_string,
+            report     = escaped_report_string, 
+            perfdata   = escaped_perfdata_string)
+        if 'shell' in reporting_config.keys() and reporting_config['shell']:
+            shell = True
+        else:
+            shell = False
+            command = shlex.split(command)
+        logging.debug("Executing reporting command: {}".format(command))
+        command_output = subprocess.run(command, 
+            shell = shell, 
+            capture_output = True)
+        if command_output.stderr:
+            logging.error("An error occurred during execution of reporting command: {}".format(command_output.stderr.decode(errors='ignore')))
+        if command_output.stdout:
+            logging.info("Output of reporting command: {}".format(command_output.stdout.decode(errors='ignore')))
+
+def write_json(file, data):
+    # The file is replaced atomically, so monitoring tools (or --merge) never read a partially written file.
+    temp_file = file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_file, file)
+
+def write_metrics(metrics_file, backup_repo, results, exitcode):
+    # Writes the metrics collected by count() and timed() of all repositories as JSON.
+    metrics = {'time': datetime.datetime.now().isoformat(), 'exitcode': exitcode, 'repositories': []}
+    for repo, result in zip(backup_repo, results):
+        values = dict(result['metrics'])
+        values['syscalls'] = sum(values.get(name, 0) for name in SYSCALLS)
+        metrics['repositories'].append({'alias': repo_alias(repo), 'directory': repo['directory'], 'exitcode': result['exitcode'],
+            'files': result['files'], 'size': result['size'], 'deleted': result['deleted'], 'metrics': values})
+    try:
+        write_json(metrics_file, metrics)
+    except OSError as err:
+        logging.error("Metrics file '{}' can't be written: {}".format(metrics_file, err))
+
+def write_results(results_file, backup_repo, results, exitcode):
+    # Writes the results of the repositories of this run (--results), so they can be combined with the results of the other
+    # shards to one report (--merge).
+    data = {'time': datetime.datetime.now().isoformat(), 'shard': "{}/{}".format(*SHARD) if SHARD else None, 'exitcode': exitcode, 'repositories': []}
+    for repo, result in zip(backup_repo, results):
+        data['repositories'].append(dict(((key, value) for key, value in result.items() if key != 'plan'), alias=repo_alias(repo), directory=str(repo['directory'])))
+    try:
+        write_json(results_file, data)
+    except OSError as err:
+        logging.error("Results file '{}' can't be written: {}".format(results_file, err))
+
+def merge_results(parsed_config, backup_repo, results_files):
+    # Combines the results files of all shards (--merge) to one report in config order and reports it like a normal run.
+    # A repository skipped by one shard, because another one held its lock, gets the result of the other shard. Repositories
+    # without a result in any of the files are CRITICAL.
+    merged = {}
+    for results_file in results_files:
+        try:
+            with open(results_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as err:
+            logging.error("Results file '{}' can't be read: {}".format(results_file, err))
+            continue
+        logging.info("Merging results of shard {} from {} ('{}'). ".format(data['shard'], data['time'], results_file))
+        for result in data['repositories']:
+            key = (result['alias'], result['directory'])
+            if not key in merged.keys() or (merged[key].get('skipped') and not result.get('skipped')):
+                merged[key] = result
+    results = []
+    for repo in backup_repo:
+        key = (repo_alias(repo), str(repo['directory']))
+        if key in merged.keys():
+            results.append(merged[key])
+        else:
+            log = "No result from any shard. "
+            logging.error(repo_alias(repo) + ": " + log)
+            results.append(skipped_result(repo, 2, log))
+    return report(parsed_config, backup_repo, results)
+
+def report(parsed_config, backup_repo, results):
+    # Builds the report of all repositories, executes the reporting command and logs the report. Returns the exit code.
+    # With --results, the results are written to the results file instead. The merge step (--merge) then writes the
+    # metrics file and executes the reporting command for all shards.
+    exitcode, report_string, perfdata_string = build_report(backup_repo, results)
+    if RESULTS:
+        write_results(RESULTS, backup_repo, results, exitcode)
+    else:
+        # frequent --check-only runs would replace the metrics of the full runs (used by 'shard_by: duration'):
+        if 'metrics_file' in parsed_config.keys() and not CHECK_ONLY:
+            write_metrics(str(parsed_config['metrics_file']), backup_repo, results, exitcode)
+        if 'reporting' in parsed_config.keys():
+            run_reporting_command(parsed_config['reporting'], exitcode, report_string, perfdata_string)
+
+    logging.info(" ===== Execution Report ===== \n{}\n ".format(report_string))
+    logging.debug(" ========= Perfdata ========= \n{}\n ".format(perfdata_string))
+    return exitcode
+
+class Inotify:
+    # Minimal wrapper around the inotify API of the Linux kernel (via ctypes, so no additional libraries are needed).
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, len (followed by the name)
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        import ctypes, ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {} # watch descriptor -> directory
+
+    def add_watch(self, directory, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), mask)
+        if wd < 0:
+            import ctypes
+            raise OSError(ctypes.get_errno(), "{}: '{}'".format(os.strerror(ctypes.get_errno()), directory))
+        self.watches[wd] = str(directory)
+
+    def read_events(self):
+        # Returns all pending events as (directory, name, mask) tuples without blocking.
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+                offset += self.EVENT.size + length
+                if mask & self.IN_IGNORED:
+                    # watched directory was deleted:
+                    self.watches.pop(wd, None)
+                    continue
+                events.append((self.watches.get(wd), os.fsdecode(name), mask))
+
+    def close(self):
+        os.close(self.fd)
+
+def watch(parsed_config, backup_repo, run):
+    # Daemon mode (--watch): after processing all repositories once, new or completely written files matching the pattern
+    # of a repository are detected with inotify and only this repository is processed again. Pull commands are executed
+    # every 'pull_interval' seconds and repositories are checked again as soon as their newest file exceeds 'warn_age'.
+    # The report is sent when the state of a repository changes and optionally every 'report_interval' seconds.
+    import select
+    watch_cfg = parsed_config['watch'] if 'watch' in parsed_config.keys() and parsed_config['watch'] else {}
+    pull_interval = float(watch_cfg['pull_interval']) if 'pull_interval' in watch_cfg.keys() else 900
+    report_interval = float(watch_cfg['report_interval']) if 'report_interval' in watch_cfg.keys() else None
+    settle_time = float(watch_cfg['settle_time']) if 'settle_time' in watch_cfg.keys() else 5
+
+    try:
+        inotify = Inotify()
+    except OSError as err:
+        logging.critical("Watch mode is not available: {}".format(err))
+        return 3
+
+    # stop cleanly on SIGTERM:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    mask = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE
+    watched = {} # directory -> numbers of the repositories in this directory
+    segments = [compile_pattern(repo['pattern'], compressed_extensions(repo)) for repo in backup_repo]
+
+    def add_watches(num, directory):
+        # patterns with subdirectories (like "**/*.bck") need a watch for each subdirectory:
+        directories = [directory]
+        if len(segments[num]) > 1:
+            directories += [os.path.join(root, name) for root, dirs, files in os.walk(directory) for name in dirs]
+        for directory in directories:
+            try:
+                if not directory in watched.keys():
+                    inotify.add_watch(directory, mask)
+                watched.setdefault(directory, set()).add(num)
+            except OSError as err:
+                logging.error("{}: Cannot watch directory: {}. ".format(repo_alias(backup_repo[num]), err))
+
+    def next_pull_time(num, now):
+        repo = backup_repo[num]
+        return now + (float(repo['pull']['interval']) if 'interval' in repo['pull'].keys() else pull_interval)
+
+    for num, repo in enumerate(backup_repo):
+        if Path(repo['directory']).is_dir():
+            add_watches(num, str(Path(repo['directory'])))
+
+    logging.info("Watching {} director{} of {} backup repositor{}. ".format(len(watched), "y" if len(watched) == 1 else "ies", len(backup_repo), "y" if len(backup_repo) == 1 else "ies"))
+
+    changed = {} # repository number -> time of the last file event
+    checked_deadlines = {} # repository number -> warn_age deadline which was already checked
+
+    def warn_age_deadline(num):
+        if 'warn_age' in backup_repo[num].keys() and results[num]['newest_mtime'] is not None:
+            deadline = results[num]['newest_mtime'] + float(backup_repo[num]['warn_age']) * 86400 + 1
+            if checked_deadlines.get(num) != deadline:
+                return deadline
+        return None
+
+    def check_deadlines(nums, now):
+        # deadlines which already passed when a repository was processed are reported by this run, so they are not checked again:
+        for num in nums:
+            deadline = warn_age_deadline(num)
+            if deadline is not None and deadline <= now:
+                checked_deadlines[num] = deadline
+
+    def handled(num, path):
+        # True if a file event of a repository was caused before its last scan started (e.g. by its pull command), so the
+        # file was already processed. The change time of a file is also updated when it is renamed into the directory.
+        scan_time = results[num]['scan_time']
+        try:
+            return scan_time is not None and os.stat(path).st_ctime < scan_time
+        except OSError:
+            return True # already removed again
+
+    def handle_events(nums=()):
+        # Marks repositories with new files as changed. Events of the repositories in 'nums' (which were just processed) are
+        # only considered for files which changed after the scan of the repository started.
+        for directory, name, event_mask in inotify.read_events():
+            if event_mask & Inotify.IN_Q_OVERFLOW:
+                logging.warning("Too many file events, checking all backup repositories. ")
+                changed.update((num, time.time()) for num in range(len(backup_repo)))
+                continue
+            if not directory in watched.keys():
+                continue
+            if name.startswith(INTERNAL_PREFIX):
+                continue # lock and temporary files of the script itself
+            path = os.path.join(directory, name)
+            for num in watched[directory]:
+                if event_mask & Inotify.IN_ISDIR:
+                    if event_mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO) and len(segments[num]) > 1:
+                        # the new directory might already contain files:
+                        add_watches(num, path)
+                        if not (num in nums and handled(num, path)):
+                            changed[num] = time.time()
+                elif segments[num][-1] is None or segments[num][-1].match(name):
+                    if num in nums and handled(num, path):
+                        continue
+                    logging.debug("{}: New file '{}'. ".format(repo_alias(backup_repo[num]), path))
+                    changed[num] = time.time()
+
+    results = run(backup_repo)
+    exitcode = report(parsed_config, backup_repo, results)
+    last_report = time.time()
+    check_deadlines(range(len(backup_repo)), last_report)
+    handle_events(range(len(backup_repo)))
+    states = [result['exitcode'] for result in results]
+    next_pull = dict((num, next_pull_time(num, last_report)) for num, repo in enumerate(backup_repo) if 'pull' in repo.keys() and 'command' in repo['pull'].keys())
+
+    try:
+        while True:
+            now = time.time()
+            due = set(num for num, event_time in changed.items() if now - event_time >= settle_time)
+            pulls = set(num for num, pull_time in next_pull.items() if pull_time <= now)
+            for num in range(len(backup_repo)):
+                deadline = warn_age_deadline(num)
+                if deadline is not None and deadline <= now:
+                    logging.debug("{}: Newest file exceeds 'warn_age'. ".format(repo_alias(backup_repo[num])))
+                    checked_deadlines[num] = deadline
+                    due.add(num)
+
+            if due or pulls:
+                nums = sorted(due | pulls)
+                for num, result in zip(nums, run([backup_repo[num] for num in nums], [backup_repo[num] for num in sorted(pulls)])):
+                    results[num] = result
+                for num in pulls:
+                    next_pull[num] = next_pull_time(num, now)
+                for num in nums:
+                    changed.pop(num, None)
+                check_deadlines(nums, time.time())
+                # events caused by the pull commands of these repositories are already handled:
+                handle_events(nums)
+
+            new_states = [result['exitcode'] for result in results]
+            if (due or pulls) and new_states != states:
+                logging.info("State of backup repositories changed. Sending report. ")
+                exitcode = report(parsed_config, backup_repo, results)
+                last_report = time.time()
+            elif report_interval and time.time() - last_report >= report_interval:
+                exitcode = report(parsed_config, backup_repo, results)
+                last_report = time.time()
+            states = new_states
+
+            # wait for file events or the next timer:
+            timers = [event_time + settle_time for event_time in changed.values()] + list(next_pull.values())
+            timers += [deadline for deadline in (warn_age_deadline(num) for num in range(len(backup_repo))) if deadline is not None]
+            if report_interval:
+                timers.append(last_report + report_interval)
+            timeout = min(max(min(timers) - time.time(), 0.1), 3600) if timers else 3600
+            select.select([inotify.fd], [], [], timeout)
+            handle_events()
+    except KeyboardInterrupt:
+        logging.info("Watch mode stopped. ")
+    finally:
+        inotify.close()
+    return exitcode
+
+def config_cache_file(config_file):
+    return CONFIG_CACHE_DIR / "config-{}.json".format(hashlib.sha256(str(Path(config_file).resolve()).encode()).hexdigest()[:16])
+
+def config_cache_key(config_content):
+    # the cache is invalidated if the config file or the script itself changes:
+    return hashlib.sha256(config_content + VERSION.encode() + str(os.stat(__file__).st_mtime_ns).encode()).hexdigest()
+
+def load_config_cache(config_file, key):
+    # Returns the cached config (merged with defaults and validated) or None if there is no valid cache entry.
+    try:
+        with open(config_cache_file(config_file), 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('key') != key:
+        return None
+    return cached
+
+def save_config_cache(config_file, key, parsed_config, compliance_rules, config_errors):
+    cached = {'key': key, 'config': parsed_config,
+        'compliance_rules': [dump_compliance_checks(compliance_rules[id(repo)]) if id(repo) in compliance_rules.keys() else None for repo in parsed_config['backup_repository']],
+        'config_errors': [config_errors.get(id(repo), []) for repo in parsed_config['backup_repository']]}
+    try:
+        content = json.dumps(cached)
+        # values YAML knows but JSON doesn't (like dates) would come back different from the cache:
+        if json.loads(content)['config'] != parsed_config:
+            logging.debug("Config can't be cached, because it contains values which can't be stored as JSON. ")
+            return
+        cache_file = config_cache_file(config_file)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = cache_file.with_name(cache_file.name + ".{}.tmp".format(os.getpid()))
+        with open(temp_file, 'w') as f:
+            f.write(content)
+        os.replace(temp_file, cache_file)
+        # one file is written per config path, so old ones (e.g. of temporary configs) are removed:
+        cache_files = sorted(cache_file.parent.glob("config-*.json"), key=lambda file: file.stat().st_mtime, reverse=True)
+        for old_file in cache_files[CONFIG_CACHE_FILES:]:
+            old_file.unlink(missing_ok=True)
+    except (OSError, TypeError, ValueError) as err:
+        logging.debug("Config cache can't be written: {}".format(err))
+
+def main(config_file):
+    # Parse config file. Merging defaults and validating the config is skipped if the config file didn't change since the last run:
+    with open(config_file, 'rb') as stream:
+        config_content = stream.read()
+    cache_key = config_cache_key(config_content)
+    cached = load_config_cache(config_file, cache_key)
+    if cached:
+        parsed_config = cached['config']
+    else:
+        import yaml # requires pyyaml (pip install pyyaml)
+        parsed_config = yaml.load(config_content, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) # the C implementation is a lot faster
+
+    log_cfg = parsed_config['logging']
+    backup_repo = parsed_config['backup_repository']
+
+    # Logging config:
+    if DEBUG:
+        logging.basicConfig(filename=None, level="DEBUG", format='%(asctime)s %(levelname)s: %(message)s')
+    else:
+        logging.basicConfig(filename=log_cfg['file'] if 'file' in log_cfg.keys() else None, level=log_cfg['level'].upper(), format='%(asctime)s %(levelname)s: %(message)s')
+
+    logging.debug("Parsed Config{}: \n{}".format(" (from cache '{}')".format(config_cache_file(config_file)) if cached else "", parsed_config))
+
+    # number of repositories processed at the same time (--jobs overwrites 'parallelism' from config file).
+    # cProfile only profiles the thread it was started in, so with --profile all repositories are processed in the main thread:
+    if PROFILE:
+        jobs = 1
+    elif JOBS:
+        jobs = JOBS
+    elif 'parallelism' in parsed_config.keys():
+        jobs = int(parsed_config['parallelism'])
+    else:
+        jobs = 1
+
+    # compile and validate compliance checks of all repositories before any file is touched:
+    compliance_rules = {}
+    config_errors = {}
+    if cached:
+        for repo, rules, errors in zip(backup_repo, cached['compliance_rules'], cached['config_errors']):
+            if rules is not None:
+                compliance_rules[id(repo)] = load_compliance_checks(rules)
+            if errors:
+                config_errors[id(repo)] = errors
+    else:
+        for repo in backup_repo:
+            merge_defaults(repo, parsed_config)
+            if 'compliance_check' in repo.keys():
+                compliance_rules[id(repo)], config_errors[id(repo)] = compile_compliance_checks(repo['compliance_check'])
+            if 'compare_with_previous' in repo.keys() and 'ignore_regex' in repo['compare_with_previous'].keys():
+                try:
+                    re.compile(repo['compare_with_previous']['ignore_regex'], flags=re.MULTILINE)
+                except re.error as err:
+                    config_errors.setdefault(id(repo), []).append("Invalid ignore_regex '{}': {}. ".format(repo['compare_with_previous']['ignore_regex'], err))
+            for period in ('weekly', 'monthly', 'yearly'):
+                if period in repo.keys() and 'compress' in repo[period].keys() and not repo[period]['compress'] in (False, None) + tuple(COMPRESSION.keys()):
+                    config_errors.setdefault(id(repo), []).append("Invalid value '{}' for compress of {} directory (possible values: {}). ".format(
+                        repo[period]['compress'], period, ", ".join(COMPRESSION.keys())))
+            if 'dedup' in repo.keys() and not repo['dedup'] in (False, None, 'hardlink', 'reflink'):
+                config_errors.setdefault(id(repo), []).append("Invalid value '{}' for dedup (possible values: hardlink, reflink). ".format(repo['dedup']))
+            if 'integrity' in repo.keys() and type(repo['integrity']) is dict:
+                for key, minimum in (('verify_runs', 0), ('workers', 1)):
+                    if key in repo['integrity'].keys() and not (type(repo['integrity'][key]) is int and repo['integrity'][key] >= minimum):
+                        config_errors.setdefault(id(repo), []).append("Invalid value '{}' for {} of integrity (must be a number >= {}). ".format(repo['integrity'][key], key, minimum))
+            elif 'integrity' in repo.keys() and not type(repo['integrity']) is bool and repo['integrity'] is not None:
+                config_errors.setdefault(id(repo), []).append("Invalid value '{}' for integrity (possible values: true, false or a dict with 'verify_runs' and 'workers'). ".format(repo['integrity']))
+        save_config_cache(config_file, cache_key, parsed_config, compliance_rules, config_errors)
+
+    if MERGE is not None:
+        return merge_results(parsed_config, backup_repo, MERGE)
+
+    # only process the repositories of this shard (--shard):
+    if SHARD:
+        # the metrics file is only written by the merge step of sharded runs, so all shards of a run see the same durations:
+        shard_by = parsed_config['shard_by'] if 'shard_by' in parsed_config.keys() else 'alias'
+        durations = None
+        if shard_by == 'duration' and 'metrics_file' in parsed_config.keys():
+            durations = load_durations(str(parsed_config['metrics_file']))
+        elif shard_by == 'duration':
+            logging.error("'shard_by: duration' requires 'metrics_file'. Using 'alias'. ")
+        elif shard_by != 'alias':
+            logging.error("Invalid value '{}' for shard_by (possible values: alias, duration). Using 'alias'. ".format(shard_by))
+        backup_repo = shard_repositories(backup_repo, SHARD[0], SHARD[1], durations)
+        logging.info("Processing shard {}/{} with {} backup repositor{}. ".format(SHARD[0], SHARD[1], len(backup_repo), "y" if len(backup_repo) == 1 else "ies"))
+
+    # directory for persistent state like the scan index:
+    state_dir = None
+    if 'state_dir' in parsed_config.keys():
+        state_dir = Path(parsed_config['state_dir'])
+        if not state_dir.is_dir():
+            logging.error("'state_dir' '{}' does not exist. Please create the directory. Continuing without persistent state. ".format(state_dir))
+            state_dir = None
+
+    # pull commands mostly wait for the network, so by default they run in parallel independent of 'jobs':
+    max_pulls = max(min(sum(1 for repo in backup_repo if 'pull' in repo.keys() and 'command' in repo['pull'].keys()), MAX_PARALLEL_PULLS), 1)
+    max_pulls_per_host = None
+    # a limit below 1 would never start a pull command:
+    if 'max_parallel_pulls' in parsed_config.keys():
+        if type(parsed_config['max_parallel_pulls']) is int and parsed_config['max_parallel_pulls'] >= 1:
+            max_pulls = parsed_config['max_parallel_pulls']
+        else:
+            logging.error("Invalid value '{}' for max_parallel_pulls (must be a number >= 1). Using {}. ".format(parsed_config['max_parallel_pulls'], max_pulls))
+    if 'max_parallel_pulls_per_host' in parsed_config.keys():
+        if type(parsed_config['max_parallel_pulls_per_host']) is int and parsed_config['max_parallel_pulls_per_host'] >= 1:
+            max_pulls_per_host = parsed_config['max_parallel_pulls_per_host']
+        else:
+            logging.error("Invalid value '{}' for max_parallel_pulls_per_host (must be a number >= 1). Not limiting pulls per host. ".format(parsed_config['max_parallel_pulls_per_host']))
+    transfers = Transfers(int(parsed_config['max_parallel_transfers']) if 'max_parallel_transfers' in parsed_config.keys() else 1,
+        float(parsed_config['max_transfer_rate']) if 'max_transfer_rate' in parsed_config.keys() else None,
+        int(parsed_config['max_parallel_compressions']) if 'max_parallel_compressions' in parsed_config.keys() else None)
+    def run(repos, pulling=None):
+        return run_repositories(repos, jobs, state_dir, compliance_rules, config_errors, max_pulls, max_pulls_per_host, pulling, transfers)
+
+    if PLAN_ONLY:
+        results = run(backup_repo, pulling=[])
+        exitcode, report_string, perfdata_string = build_report(backup_repo, results)
+        plans = [{'alias': repo_alias(repo), 'directory': repo['directory'], 'actions': result['plan']} for repo, result in zip(backup_repo, results)]
+        print(json.dumps(plans, indent=2, default=str))
+        # the metrics file is not written, as the durations of a plan don't match the real runs (see 'shard_by: duration'):
+        if RESULTS:
+            write_results(RESULTS, backup_repo, results, exitcode)
+        logging.info(" ===== Execution Report ===== \n{}\n ".format(report_string))
+        return exitcode
+
+    try:
+        if WATCH:
+            return watch(parsed_config, backup_repo, run)
+        # no pull commands with --check-only:
+        return report(parsed_config, backup_repo, run(backup_repo, pulling=[] if CHECK_ONLY else None))
+    finally:
+        transfers.close() # waits for the compression processes
+
+
+def cli(argv=None):
+    # Parses the command line arguments into the options above, runs the script and exits with its exit code.
+    global conf_path, DEBUG, JOBS, REBUILD_INDEX, WATCH, PLAN_ONLY, CHECK_ONLY, SHARD, RESULTS, MERGE, PROFILE
+    argv = sys.argv[1:] if argv is None else argv
+
+    # Parse arguments:
+    for arg_num, arg in enumerate(argv, start=1):
+        if arg == "-h" or arg == "--help":
+            print(usage)
+            sys.exit(0)
+        elif arg == "-v" or arg == "--version":
+            print("bck_mgmt.py version {}".format(VERSION))
+            sys.exit(0)
+        elif arg == "-d" or arg == "--debug":
+            DEBUG = True
+        elif (arg == "-c" or arg == "--conf") and arg_num < len(argv):
+            conf_path = argv[arg_num]
+        elif arg == "--rebuild-index":
+            REBUILD_INDEX = True
+        elif arg == "--plan-only":
+            PLAN_ONLY = True
+        elif arg == "--check-only":
+            CHECK_ONLY = True
+        elif arg == "--watch":
+            WATCH = True
+        elif arg == "--profile" and arg_num < len(argv):
+            PROFILE = argv[arg_num]
+        elif arg == "--shard" and arg_num < len(argv):
+            try:
+                SHARD = tuple(int(n) for n in argv[arg_num].split("/"))
+                if len(SHARD) != 2 or not 1 <= SHARD[0] <= SHARD[1]:
+                    raise ValueError
+            except ValueError:
+                print("ERROR: Shard must be given as <shard>/<shards>, e.g. 1/3.\n\n" + usage)
+                sys.exit(3)
+        elif arg == "--results" and arg_num < len(argv):
+            RESULTS = argv[arg_num]
+        elif arg == "--merge":
+            MERGE = argv[arg_num:]
+            break
+        elif (arg == "-j" or arg == "--jobs") and arg_num < len(argv):
+            try:
+                JOBS = int(argv[arg_num])
+            except ValueError:
+                print("ERROR: Number of jobs must be an integer.\n\n" + usage)
+                sys.exit(3)
+
+    if not conf_path or not Path(conf_path).is_file():
+        print("ERROR: No config file specified or config path not found.\n\n" + usage)
+        sys.exit(3)
+
+    if PROFILE:
+        import cProfile
+        # only the main thread is profiled, so main() processes the repositories in the main thread (see 'jobs'):
+        profiler = cProfile.Profile()
+        exitcode = profiler.runcall(main, conf_path)
+        profiler.dump_stats(PROFILE)
+        sys.exit(exitcode)
+
+    sys.exit(main(conf_path))
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+
+# Benchmark for bck_mgmt.py: generates synthetic backup repositories in a temporary directory, runs bck_mgmt.py with
+# --plan-only (and 'delete_old: false') against them and records the duration of the phases (scan, compliance, compare,
+# retention) from the results file of bck_mgmt.py (--results) to a JSON results file, so runs of different versions can be compared over time.
+
+import yaml # requires pyyaml (pip install pyyaml)
+from pathlib import Path
+import datetime
+import sys
+import os
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import platform
+
+BCK_MGMT = Path(__file__).resolve().parent / 'bck_mgmt.py'
+DAY = 86400
+
+# default parameters (can be overwritten with command line options):
+FILE_COUNTS = [1000, 10000, 100000]
+YEARS = 5
+MIN_SIZE = 1024
+MAX_SIZE = 16384
+BINARY = False
+SUBDIRS = False
+NESTED = 0 # depth of the '**' directory layout (0 = all files in the base directory)
+RUNS = 3
+INDEX = False
+SEED = 1
+RESULTS_FILE = 'benchmark-results.json'
+KEEP = False
+
+usage = """Usage:
+  {} [-n <files>[,<files>...]] [--years <years>] [--size <min>-<max>] [--binary] [--subdirs] [--nested <depth>]
+               [--runs <runs>] [--index] [--seed <seed>] [-o <results>] [--keep] [-h]
+
+Options:
+  -n, --files <files>  comma separated list of file counts to generate (default: {})
+  --years <years>      spread the modification times of the files over this many years (default: {})
+  --size <min>-<max>   range of the file sizes in bytes (default: {}-{})
+  --binary             generate random binary files instead of config-like text files
+  --subdirs            also generate files in weekly, monthly and yearly directories
+  --nested <depth>     distribute the files over subdirectories of this depth and use a '**' pattern
+  --runs <runs>        number of runs for each file count (default: {})
+  --index              use 'state_dir' and 'scan_index' (the first run fills the index)
+  --seed <seed>        seed for the random generator, so repositories can be generated again (default: {})
+  -o, --output <file>  append the results to this JSON file (default: {})
+  --keep               don't remove the generated repositories
+  -h, --help           display this help and exit""".format(sys.argv[0], ",".join(str(n) for n in FILE_COUNTS), YEARS,
+    MIN_SIZE, MAX_SIZE, RUNS, SEED, RESULTS_FILE)
+
+
+def text_content(rng, number, size):
+    # Config-like text file. Each file differs in a few lines from the previous one, so the comparison has something to do.
+    lines = ["! saved at {}\n".format(number), "hostname bench\n", "ip access-list 1 1.2.3.4\n"]
+    length = sum(len(line) for line in lines)
+    i = 0
+    while length < size:
+        line = "interface eth{} description {} vlan {}\n".format(i, "changed" if rng.random() < 0.01 else "uplink", i % 4094)
+        lines.append(line)
+        length += len(line)
+        i += 1
+    return "".join(lines).encode()
+
+def directory_layout(root, depth, fanout=4):
+    # Returns all leaf directories of a tree with the given depth below root.
+    dirs = [root]
+    for level in range(depth):
+        dirs = [d / "d{}".format(i) for d in dirs for i in range(fanout)]
+    return dirs
+
+def write_file(path, content, mtime):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, content)
+    finally:
+        os.close(fd)
+    os.utime(path, (mtime, mtime))
+
+def generate_repo(root, files, rng):
+    # Generates a repository with 'files' backup files in root/base and optionally in root/weekly, root/monthly and root/yearly.
+    # The modification times are spread over YEARS years, the newest file is one hour old.
+    now = time.time()
+    base = root / 'base'
+    leaf_dirs = directory_layout(base, NESTED)
+    for d in leaf_dirs:
+        d.mkdir(parents=True, exist_ok=True)
+    subdir_counts = {}
+    if SUBDIRS:
+        subdir_counts = {'weekly': min(files // 20, 52), 'monthly': min(files // 20, 24), 'yearly': min(files // 20, YEARS)}
+        for name in subdir_counts.keys():
+            (root / name).mkdir()
+
+    span = YEARS * 365 * DAY
+    for i in range(files):
+        # file 0 is the oldest file:
+        mtime = now - 3600 - span * (files - 1 - i) / max(files - 1, 1)
+        size = rng.randint(MIN_SIZE, MAX_SIZE)
+        content = os.urandom(size) if BINARY else text_content(rng, i, size)
+        write_file(leaf_dirs[i % len(leaf_dirs)] / "bench_{:07d}.bck".format(i), content, mtime)
+    for name, count in subdir_counts.items():
+        for i in range(count):
+            mtime = now - span * (i + 1) / (count + 1)
+            write_file(root / name / "bench_{}_{:04d}.bck".format(name, i), os.urandom(MIN_SIZE) if BINARY else text_content(rng, i, MIN_SIZE), mtime)
+    # directories modified within the last seconds are never served from the scan index (see ScanIndex.RACY_SECONDS):
+    for directory, subdirs, names in os.walk(root):
+        os.utime(directory, (now - 60, now - 60))
+
+def write_config(root, files):
+    repo = {
+        'directory': str(root / 'base'),
+        'alias': 'bench',
+        'pattern': "**/bench_*.bck" if NESTED else "bench_*.bck",
+        'keep': max(files // 2, 1),
+        'warn_age': 1,
+        'delete_old': False,
+    }
+    if SUBDIRS:
+        for name, keep in (('weekly', 52), ('monthly', 24), ('yearly', YEARS)):
+            repo[name] = {'directory': str(root / name), 'keep': keep}
+    if not BINARY:
+        repo['compliance_check'] = [
+            {'regex': '^hostname \\S+$', 'violation_message': 'Hostname is missing!'},
+            {'regex': '^password (default|unsafe)', 'must_not_match': True},
+            {'regex': '^interface eth(\\d+) description changed', 'must_not_match': True, 'violation_message': 'Interface \\1 changed!'},
+        ]
+        repo['compare_with_previous'] = {'warn_if_changed': True, 'log_diff': True, 'ignore_regex': '^! saved at .*'}
+    else:
+        repo['compare_with_previous'] = {'warn_if_changed': True}
+    config = {
+        'backup_repository': [repo],
+        'logging': {'level': 'warning', 'file': str(root / 'bck_mgmt.log')},
+    }
+    if INDEX:
+        (root / 'state').mkdir(exist_ok=True)
+        config['state_dir'] = str(root / 'state')
+        repo['scan_index'] = True
+    config_file = root / 'config.yaml'
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config, f)
+    return config_file
+
+def run_benchmark(root, config_file):
+    # Runs bck_mgmt.py once and returns the wall clock time and the metrics of the repository.
+    start = time.perf_counter()
+    # the config cache is kept in the temporary directory as well, so it is removed together with the repository:
+    result = subprocess.run([sys.executable, str(BCK_MGMT), '-c', str(config_file), '--plan-only', '-j', '1', '--results', str(root / 'results.json')],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=dict(os.environ, XDG_CACHE_HOME=str(root / 'cache')))
+    wall_ms = (time.perf_counter() - start) * 1000
+    if result.returncode not in (0, 1, 2):
+        raise RuntimeError("bck_mgmt.py failed with exit code {}: {}".format(result.returncode, result.stderr.decode(errors='ignore')))
+    with open(root / 'results.json') as f:
+        metrics = json.load(f)['repositories'][0]
+    return dict(metrics['metrics'], wall_ms=wall_ms, exitcode=result.returncode, files=metrics['files'])
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=BCK_MGMT.parent, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    rng = random.Random(SEED)
+    results = []
+    columns = ('wall_ms', 'scan_ms', 'compliance_ms', 'compare_ms', 'retention_ms')
+    print("{:>9} {:>12} ".format('files', 'generate_ms') + " ".join("{:>13}".format(c) for c in columns))
+    for files in FILE_COUNTS:
+        root = Path(tempfile.mkdtemp(prefix='bck_mgmt_bench_'))
+        try:
+            start = time.perf_counter()
+            generate_repo(root, files, rng)
+            generate_ms = (time.perf_counter() - start) * 1000
+            config_file = write_config(root, files)
+            runs = [run_benchmark(root, config_file) for run in range(RUNS)]
+            # the fastest run is the least disturbed by other processes:
+            best = {c: min(run.get(c, 0) for run in runs) for c in columns}
+            print("{:>9} {:>12.0f} ".format(files, generate_ms) + " ".join("{:>13.1f}".format(best[c]) for c in columns))
+            results.append({'files': files, 'generate_ms': generate_ms, 'best': best, 'runs': runs})
+        finally:
+            if KEEP:
+                print("Repository kept in '{}'".format(root))
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+    entry = {
+        'time': datetime.datetime.now().isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'years': YEARS, 'min_size': MIN_SIZE, 'max_size': MAX_SIZE, 'binary': BINARY, 'subdirs': SUBDIRS,
+            'nested': NESTED, 'runs': RUNS, 'index': INDEX, 'seed': SEED},
+        'results': results,
+    }
+    # results of all benchmark runs are collected in one file:
+    history = []
+    if Path(RESULTS_FILE).is_file():
+        with open(RESULTS_FILE) as f:
+            history = json.load(f)
+    history.append(entry)
+    with open(RESULTS_FILE + '.tmp', 'w') as f:
+        json.dump(history, f, indent=2)
+    os.replace(RESULTS_FILE + '.tmp', RESULTS_FILE)
+    print("Results appended to '{}'".format(RESULTS_FILE))
+
+
+if __name__ == "__main__":
+
+    # Parse arguments:
+    args = sys.argv[1:]
+    try:
+        for arg_num, arg in enumerate(args):
+            value = args[arg_num+1] if arg_num + 1 < len(args) else None
+            if arg == "-h" or arg == "--help":
+                print(usage)
+                sys.exit(0)
+            elif (arg == "-n" or arg == "--files") and value:
+                FILE_COUNTS = [int(n) for n in value.split(",")]
+            elif arg == "--years" and value:
+                YEARS = int(value)
+            elif arg == "--size" and value:
+                MIN_SIZE, MAX_SIZE = (int(n) for n in value.split("-"))
+            elif arg == "--binary":
+                BINARY = True
+            elif arg == "--subdirs":
+                SUBDIRS = True
+            elif arg == "--nested" and value:
+                NESTED = int(value)
+            elif arg == "--runs" and value:
+                RUNS = int(value)
+            elif arg == "--index":
+                INDEX = True
+            elif arg == "--seed" and value:
+                SEED = int(value)
+            elif (arg == "-o" or arg == "--output") and value:
+                RESULTS_FILE = value
+            elif arg == "--keep":
+                KEEP = True
+    except ValueError:
+        print("ERROR: Invalid number.\n\n" + usage)
+        sys.exit(3)
+
+    main()
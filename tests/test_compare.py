@@ -0,0 +1,35 @@
+import re
+
+import bck_mgmt_core as bck_mgmt
+
+
+def write(tmp_path, name, content):
+    file = tmp_path / name
+    file.write_bytes(content.encode() if type(content) is str else content)
+    return file
+
+
+def test_ignore_regex_matches_characters(tmp_path):
+    file1 = write(tmp_path, "1.cfg", "description Straße\nsaved at 1\n")
+    file2 = write(tmp_path, "2.cfg", "description Strasse\nsaved at 2\n")
+    pattern = re.compile(r'^(description Stra.s?e|saved at \w+)$', flags=re.MULTILINE)
+    assert bck_mgmt.normalized_files_equal(file1, file2, pattern, 1048576)
+    assert bck_mgmt.normalized_hash(file1, pattern, 1048576) == bck_mgmt.normalized_hash(file2, pattern, 1048576)
+
+
+def test_multiline_ignore_regex(tmp_path):
+    file1 = write(tmp_path, "1.cfg", "user müller\n  key 1\nend\n")
+    file2 = write(tmp_path, "2.cfg", "user müller\n  key 2\nend\n")
+    pattern = re.compile(r'^user \w+\n  key \d+$', flags=re.MULTILINE)
+    assert bck_mgmt.normalized_files_equal(file1, file2, pattern, 1048576)
+    assert not bck_mgmt.normalized_files_equal(file1, file2, re.compile(r'^user \w+$', flags=re.MULTILINE), 1048576)
+
+
+def test_invalid_bytes_are_compared(tmp_path):
+    file1 = write(tmp_path, "1.cfg", b"name \xff\n")
+    file2 = write(tmp_path, "2.cfg", b"name \xfe\n")
+    pattern = re.compile(r'^date .*$', flags=re.MULTILINE)
+    assert not bck_mgmt.normalized_files_equal(file1, file2, pattern, 1048576)
+    assert bck_mgmt.normalized_hash(file1, pattern, 1048576) != bck_mgmt.normalized_hash(file2, pattern, 1048576)
+    # without matches, the hash is the hash of the raw content:
+    assert bck_mgmt.normalized_hash(file1, pattern, 1048576) == bck_mgmt.hash_file(file1)
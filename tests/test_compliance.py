@@ -0,0 +1,78 @@
+import bck_mgmt_core as bck_mgmt
+
+
+def check(tmp_path, checks, content):
+    rule_set, errors = bck_mgmt.compile_compliance_checks(checks)
+    assert errors == []
+    file = tmp_path / "backup.cfg"
+    file.write_bytes(content.encode() if type(content) is str else content)
+    with bck_mgmt.map_file(file) as content_map:
+        results, times = bck_mgmt.run_compliance_checks(rule_set, content_map)
+    assert len(times) == len(results)
+    return results
+
+
+def test_regexes_match_characters(tmp_path):
+    results = check(tmp_path, [{'regex': r'^hostname \w+$'}, {'regex': r'^description Stra.e$'}, {'regex': r'^[äöü]+$'}],
+        "hostname müller\ndescription Straße\näöü\n")
+    assert [bool(match) for rule, match in results] == [True, True, True]
+
+
+def test_violation_message_is_expanded_on_the_text(tmp_path):
+    checks = [{'regex': r'^hostname (\w+)$', 'must_not_match': True, 'violation_message': r'Hostname \1 is not allowed'}]
+    (rule, match), = check(tmp_path, checks, "interface 1\nhostname müller\n")
+    assert match.expand(rule['violation_message']) == "Hostname müller is not allowed"
+
+
+def test_invalid_violation_message(tmp_path):
+    rule_set, errors = bck_mgmt.compile_compliance_checks([{'regex': r'^hostname (\w+)$', 'must_not_match': True, 'violation_message': r'\2'}])
+    assert rule_set['rules'] == []
+    assert len(errors) == 1
+
+
+def test_invalid_bytes_are_replaced(tmp_path):
+    results = check(tmp_path, [{'regex': r'^name .$'}, {'regex': r'^end$'}], b"name \xff\nend\n")
+    assert [bool(match) for rule, match in results] == [True, True]
+
+
+def test_multiline_and_line_based_rules(tmp_path):
+    checks = [{'regex': r'hostname fw\nip'}, {'regex': r'^ip 1\.2\.3\.4$'}, {'regex': r'^password'}]
+    results = check(tmp_path, checks, "hostname fw\nip 1.2.3.4\n")
+    assert [bool(match) for rule, match in results] == [True, True, False]
+
+
+def test_chunks_end_at_line_breaks(tmp_path, monkeypatch):
+    # small chunks, so the lines are spread over several chunks:
+    decoded_chunks = bck_mgmt.decoded_chunks
+    monkeypatch.setattr(bck_mgmt, 'decoded_chunks', lambda content: decoded_chunks(content, 10))
+    content = "".join("line {} größe\n".format(n) for n in range(100)) + "last"
+    checks = [{'regex': r'^line 57 gr..e$'}, {'regex': r'^last$'}, {'regex': r'^$'}, {'regex': r'^line 7$'}]
+    results = check(tmp_path, checks, content)
+    assert [bool(match) for rule, match in results] == [True, True, False, False]
+    assert [bool(match) for rule, match in check(tmp_path, [{'regex': r'^$'}], content + "\n")] == [True]
+    assert list(decoded_chunks(b"a\nbb\nccc", 2)) == [("a\n", False), ("bb\n", False), ("ccc", True)]
+
+
+def test_large_files_are_checked_line_by_line(tmp_path):
+    # bigger than the default 'max_file_size', which only applies to rules matching across lines:
+    content = "interface 1\n" * 200000 + "password unsafe\n"
+    (tmp_path / "backup.cfg").write_text(content)
+    checks = [{'regex': r'^password (\w+)$', 'must_not_match': True, 'violation_message': r'Password \1 set'}, {'regex': r'interface 1\ninterface 2'}]
+    rule_set, errors = bck_mgmt.compile_compliance_checks(checks)
+    repo = {'directory': str(tmp_path), 'alias': "test", 'pattern': "*.cfg", 'compliance_check': checks}
+    result = bck_mgmt.process_repo(repo, compliance_rules=rule_set)
+    assert len(content) > bck_mgmt.MAX_FILE_SIZE_FOR_COMPLIANCE_CHECK
+    assert "Password unsafe set" in result['crit_str']
+    assert "can't be loaded for compliance checking" in result['warn_str']
+
+
+def test_rule_times_are_not_accumulated(tmp_path):
+    # the compiled rules are reused by every run in watch mode and with the config cache:
+    rule_set, errors = bck_mgmt.compile_compliance_checks([{'regex': r'^hostname \w+$'}, {'regex': r'a\nb'}])
+    cached = bck_mgmt.load_compliance_checks(bck_mgmt.dump_compliance_checks(rule_set))
+    for rules in (rule_set, cached):
+        before = [dict(rule) for rule in rules['rules']]
+        for run in range(3):
+            results, times = bck_mgmt.run_compliance_checks(rules, b"hostname fw\na\nb\n")
+            assert all(time >= 0 for time in times)
+        assert rules['rules'] == before
@@ -0,0 +1,37 @@
+import os
+
+import bck_mgmt_core as bck_mgmt
+
+
+def create(tmp_path, content=b"backup data\n" * 100):
+    (tmp_path / "state").mkdir()
+    digests = bck_mgmt.DigestStore(bck_mgmt.open_state_db(tmp_path / "state"))
+    files = {}
+    for name in ("a.bck", "b.bck"):
+        path = tmp_path / name
+        path.write_bytes(content)
+        os.utime(path, ns=(1000000000000000000, 1000000000000000000))
+        files[path] = len(content)
+    return digests, files
+
+
+def test_dedup_hardlinks_identical_files(tmp_path):
+    digests, files = create(tmp_path)
+    assert bck_mgmt.dedup_files("test", files, 'hardlink', digests, bck_mgmt.ScanIndex()) == (1, 1200, 0)
+    assert os.stat(tmp_path / "a.bck").st_ino == os.stat(tmp_path / "b.bck").st_ino
+    # nothing left to do in the next run:
+    assert bck_mgmt.dedup_files("test", files, 'hardlink', digests, bck_mgmt.ScanIndex()) == (0, 0, 0)
+
+
+def test_dedup_compares_content_before_replacing(tmp_path):
+    digests, files = create(tmp_path)
+    for path in files.keys():
+        digests.digest(path)
+    # the kept file is corrupted without changing its size or mtime, so its stored hash is still used:
+    source = tmp_path / "a.bck"
+    with open(source, 'r+b') as f:
+        f.write(b"X")
+    os.utime(source, ns=(1000000000000000000, 1000000000000000000))
+    assert bck_mgmt.dedup_files("test", files, 'hardlink', digests, bck_mgmt.ScanIndex()) == (0, 0, 1)
+    assert os.stat(tmp_path / "a.bck").st_ino != os.stat(tmp_path / "b.bck").st_ino
+    assert (tmp_path / "b.bck").read_bytes() == b"backup data\n" * 100
@@ -0,0 +1,115 @@
+import difflib
+import logging
+import random
+
+import bck_mgmt_core as bck_mgmt
+
+
+def apply_changes(a, b, changes):
+    # rebuilds b from a and the changed sections, checking that all lines between the changes are unchanged
+    result = []
+    a_pos = b_pos = 0
+    for a_lo, a_hi, b_lo, b_hi in changes:
+        assert a_lo - a_pos == b_lo - b_pos
+        assert a[a_pos:a_lo] == b[b_pos:b_lo]
+        result += a[a_pos:a_lo] + b[b_lo:b_hi]
+        a_pos, b_pos = a_hi, b_hi
+    assert a[a_pos:] == b[b_pos:]
+    return result + a[a_pos:]
+
+
+def lcs_length(a, b):
+    lengths = [0] * (len(b) + 1)
+    for x in a:
+        previous = 0
+        for j, y in enumerate(b):
+            previous, lengths[j + 1] = lengths[j + 1], previous + 1 if x == y else max(lengths[j + 1], lengths[j])
+    return lengths[-1]
+
+
+def test_random_diffs_are_valid():
+    rng = random.Random(1)
+    for run in range(300):
+        a = [rng.randrange(6) for i in range(rng.randrange(30))]
+        b = list(a)
+        for edit in range(rng.randrange(6)):
+            position = rng.randrange(len(b) + 1)
+            if b and rng.random() < 0.5:
+                del b[min(position, len(b) - 1)]
+            else:
+                b.insert(position, rng.randrange(6))
+        changes = []
+        bck_mgmt.diff_sections(a, 0, len(a), b, 0, len(b), changes)
+        assert apply_changes(a, b, changes) == b
+        assert changes == sorted(changes)
+
+
+def edit_distance(a, b):
+    return len(a) + len(b) - 2 * lcs_length(a, b)
+
+
+def test_middle_snake_is_on_a_shortest_edit_script():
+    rng = random.Random(2)
+    for run in range(300):
+        a = [rng.randrange(3) for i in range(rng.randrange(1, 25))]
+        b = [rng.randrange(3) for i in range(rng.randrange(1, 25))]
+        x_start, y_start, x_end, y_end = bck_mgmt.middle_snake(a, 0, len(a), b, 0, len(b), 100)
+        assert a[x_start:x_end] == b[y_start:y_end]
+        assert edit_distance(a[:x_start], b[:y_start]) + edit_distance(a[x_end:], b[y_end:]) == edit_distance(a, b)
+
+
+def test_middle_snake_max_cost():
+    assert bck_mgmt.middle_snake(list(range(100)), 0, 100, list(range(200, 300)), 0, 100, 5) is None
+
+
+def test_patience_diff_keeps_unique_lines():
+    a = ["{", "a", "}", "{", "b", "}", "unique"]
+    b = ["{", "b", "}", "unique", "{", "c", "}"]
+    changes = []
+    bck_mgmt.diff_sections(a, 0, len(a), b, 0, len(b), changes)
+    assert apply_changes(a, b, changes) == b
+    # "unique" is kept as anchor, although another alignment of the braces would need as many changes:
+    unchanged_b = set(range(len(b))) - set(j for a_lo, a_hi, b_lo, b_hi in changes for j in range(b_lo, b_hi))
+    assert 3 in unchanged_b
+
+
+def test_max_cost_replaces_section():
+    a = [0] * 50 + [1] * 50
+    b = [1] * 50 + [0] * 50
+    changes = []
+    bck_mgmt.diff_sections(a, 0, len(a), b, 0, len(b), changes)
+    assert apply_changes(a, b, changes) == b
+    assert sum(a_hi - a_lo + b_hi - b_lo for a_lo, a_hi, b_lo, b_hi in changes) == 100
+    changes = []
+    bck_mgmt.diff_sections(a, 0, len(a), b, 0, len(b), changes, max_cost=5)
+    assert changes == [(0, 100, 0, 100)]
+
+
+def test_log_diff_matches_unified_diff(tmp_path, caplog):
+    lines1 = ["line {}".format(n) for n in range(40)]
+    lines2 = list(lines1)
+    lines2[5] = "changed 5"
+    del lines2[20]
+    lines2.insert(30, "inserted")
+    lines2.append("appended")
+    file1 = tmp_path / "1.cfg"
+    file2 = tmp_path / "2.cfg"
+    file1.write_text("".join(line + "\n" for line in lines1))
+    file2.write_text("".join(line + "\n" for line in lines2))
+    with caplog.at_level(logging.INFO):
+        assert bck_mgmt.log_diff("repo", file1, file2, "old", "new", 1000) == (3, 2)
+    hunks = [message.replace("repo: ", "", 1) for message in caplog.messages[1:]]
+    expected = list(difflib.unified_diff(lines1, lines2, "old", "new", n=2, lineterm=""))[2:]
+    assert "\n".join(hunks).split("\n") == expected
+
+
+def test_log_diff_max_lines(tmp_path, caplog):
+    file1 = tmp_path / "1.cfg"
+    file2 = tmp_path / "2.cfg"
+    file1.write_text("".join("line {}\n".format(n) for n in range(100)))
+    file2.write_text("".join("line {}\n".format(n) if n % 10 else "other {}\n".format(n) for n in range(100)))
+    with caplog.at_level(logging.INFO):
+        assert bck_mgmt.log_diff("repo", file1, file2, "old", "new", 5) == (10, 10)
+    shown = [line for message in caplog.messages[1:] for line in message.split("\n") if line[:1] in "+- "]
+    assert len(shown) == 5
+    assert "Diff log truncated" in caplog.messages[-1]
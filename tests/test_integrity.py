@@ -0,0 +1,59 @@
+import os
+
+import bck_mgmt_core as bck_mgmt
+
+
+def create(tmp_path, count):
+    (tmp_path / "state").mkdir()
+    (tmp_path / "repo").mkdir()
+    for num in range(count):
+        path = tmp_path / "repo" / "f{}.bck".format(num)
+        path.write_bytes(b"backup %d\n" % num * 100)
+        os.utime(path, (1000000 + num, 1000000 + num))
+    return bck_mgmt.open_state_db(tmp_path / "state")
+
+
+def files(tmp_path):
+    return [(str(path), path.stat().st_size, path.stat().st_mtime) for path in sorted((tmp_path / "repo").iterdir())]
+
+
+def check(tmp_path, db, verify_runs, moves=()):
+    return bck_mgmt.check_integrity("test", db, str(tmp_path / "repo"), "*.bck", files(tmp_path), moves, verify_runs, 2)
+
+
+def test_corrupted_file_is_detected(tmp_path):
+    db = create(tmp_path, 4)
+    corrupted, failed, hashed, hashed_bytes, seconds = check(tmp_path, db, 1)
+    assert (corrupted, failed, hashed) == ([], 0, 4)
+    # the content changes without a change of size and mtime:
+    path = tmp_path / "repo" / "f2.bck"
+    with open(path, 'r+b') as f:
+        f.write(b"X")
+    os.utime(path, (1000002, 1000002))
+    corrupted, failed, hashed, hashed_bytes, seconds = check(tmp_path, db, 1)
+    assert (corrupted, failed, hashed) == ([str(path)], 0, 4)
+    # it stays corrupted, the old hash is kept:
+    assert check(tmp_path, db, 1)[0] == [str(path)]
+
+
+def test_changed_and_moved_files_keep_a_valid_hash(tmp_path):
+    db = create(tmp_path, 4)
+    check(tmp_path, db, 1)
+    # a file rewritten with a new mtime is hashed again, a renamed file keeps its hash:
+    (tmp_path / "repo" / "f0.bck").write_bytes(b"new content")
+    os.rename(tmp_path / "repo" / "f1.bck", tmp_path / "repo" / "moved.bck")
+    corrupted, failed, hashed, hashed_bytes, seconds = check(tmp_path, db, 1, [(str(tmp_path / "repo" / "f1.bck"), str(tmp_path / "repo" / "moved.bck"))])
+    assert (corrupted, failed) == ([], 0)
+    assert sorted(row[0] for row in db.execute("SELECT path FROM integrity")) == [path for path, size, mtime in files(tmp_path)]
+
+
+def test_files_are_verified_in_a_rotating_sample(tmp_path):
+    db = create(tmp_path, 10)
+    assert check(tmp_path, db, 5)[2] == 10
+    # each run verifies the 2 files verified longest ago, so all files are verified within 5 runs:
+    verified = set()
+    for run in range(5):
+        before = dict(db.execute("SELECT path, verified FROM integrity"))
+        assert check(tmp_path, db, 5)[2] == 2
+        verified |= set(path for path, time in db.execute("SELECT path, verified FROM integrity") if time != before[path])
+    assert len(verified) == 10
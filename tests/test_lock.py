@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+import types
+from pathlib import Path
+
+import bck_mgmt_core as bck_mgmt
+
+HOLD_LOCK = """
+import sys
+import bck_mgmt_core
+lock = bck_mgmt_core.RepoLock(sys.argv[1])
+assert lock.acquire()
+print("locked", flush=True)
+sys.stdin.read()
+"""
+
+
+def test_repo_lock_is_exclusive(tmp_path):
+    holder = subprocess.Popen([sys.executable, "-c", HOLD_LOCK, str(tmp_path)], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        cwd=str(Path(bck_mgmt.__file__).parent))
+    try:
+        assert holder.stdout.readline() == b"locked\n"
+        lock = bck_mgmt.RepoLock(tmp_path)
+        assert not lock.acquire()
+        assert lock.holder().startswith("pid {} on ".format(holder.pid))
+    finally:
+        holder.stdin.close()
+        holder.wait()
+    # the lock is released when the process holding it ends:
+    assert lock.acquire()
+    assert lock.holder().startswith("pid {} on ".format(os.getpid()))
+    lock.release()
+
+
+def test_repo_lock_without_fcntl(tmp_path, monkeypatch):
+    # on Windows, msvcrt is used instead of fcntl
+    locked = set()
+
+    def locking(fd, mode, length):
+        key = (os.path.realpath(tmp_path), os.lseek(fd, 0, os.SEEK_CUR))
+        if mode == msvcrt.LK_UNLCK:
+            locked.remove(key)
+        elif key in locked:
+            raise PermissionError(13, "Permission denied")
+        else:
+            locked.add(key)
+
+    msvcrt = types.SimpleNamespace(LK_NBLCK=2, LK_UNLCK=0, locking=locking)
+    monkeypatch.setitem(sys.modules, "fcntl", None)
+    monkeypatch.setitem(sys.modules, "msvcrt", msvcrt)
+    lock = bck_mgmt.RepoLock(tmp_path)
+    assert lock.acquire()
+    assert not bck_mgmt.RepoLock(tmp_path).acquire()
+    # the content before the locked byte can still be read:
+    assert lock.holder().startswith("pid {} on ".format(os.getpid()))
+    lock.release()
+    assert not locked
+    assert bck_mgmt.RepoLock(tmp_path).acquire()
@@ -0,0 +1,191 @@
+import datetime
+import os
+import random
+import shutil
+from pathlib import Path
+
+import pytest
+
+import bck_mgmt_core as bck_mgmt
+
+DAY = 86400
+NOW = datetime.datetime(2025, 6, 15, 12).timestamp()
+
+
+def create_files(directory, files):
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, age, size in files:
+        path = directory / name
+        path.write_bytes(b"x" * size)
+        os.utime(path, (NOW - age * DAY, NOW - age * DAY))
+
+
+def scan(directory, pattern="*.bck"):
+    return bck_mgmt.scan_directory(directory, bck_mgmt.compile_pattern(pattern))
+
+
+def tree(directory):
+    return dict((str(path.relative_to(directory)), (path.stat().st_mtime, path.stat().st_size))
+        for path in sorted(directory.rglob("*")) if path.is_file())
+
+
+def baseline_cleanup(repo):
+    # The clean up of the original script before it was split into plan_retention() and execute_plan(), without
+    # pull commands, checks and logging. Returns the number and size of the remaining files and the number of deleted files.
+    current_dir = Path(repo['directory'])
+    dir_files = dir_size = files_deleted = 0
+    sorted_file_list = sorted(((file.stat().st_mtime, file, file.stat().st_size) for file in current_dir.glob(repo['pattern']) if file.is_file()))
+    subdirs = []
+    paths = {'weekly': None, 'monthly': None, 'yearly': None}
+    used = {}
+    for period, date_format in (('weekly', "%G-%V"), ('monthly', "%Y-%m"), ('yearly', "%Y")):
+        if period in repo.keys():
+            paths[period] = current_dir / Path(repo[period]['directory'])
+            used[period] = list(datetime.date.fromtimestamp(f.stat().st_mtime).strftime(date_format) for f in paths[period].glob(repo['pattern']))
+            subdirs.append(period)
+    move_old_path = current_dir / Path(repo['move_old_to']) if 'move_old_to' in repo.keys() else None
+
+    for file_num, file in enumerate(sorted_file_list):
+        current_file = file[1]
+        current_file_mtime = datetime.datetime.fromtimestamp(file[0])
+        if 'keep' in repo.keys() and (len(sorted_file_list) - file_num) > int(repo['keep']):
+            destination = None
+            filename = repo['rename_moved_files'].format(current_file.name) if 'rename_moved_files' in repo.keys() else current_file.name
+            if paths['yearly'] and not current_file_mtime.strftime("%Y") in used['yearly']:
+                destination = paths['yearly'] / Path(filename)
+                used['yearly'].append(current_file_mtime.strftime("%Y"))
+            elif paths['monthly'] and not current_file_mtime.strftime("%Y-%m") in used['monthly']:
+                destination = paths['monthly'] / Path(filename)
+                used['monthly'].append(current_file_mtime.strftime("%Y-%m"))
+            elif paths['weekly'] and not current_file_mtime.strftime("%G-%V") in used['weekly']:
+                destination = paths['weekly'] / Path(filename)
+                used['weekly'].append(current_file_mtime.strftime("%G-%V"))
+            elif move_old_path:
+                destination = move_old_path / Path(filename)
+            if destination is not None:
+                if not destination.exists():
+                    shutil.move(current_file, destination)
+            elif 'delete_old' in repo.keys() and repo['delete_old']:
+                current_file.unlink()
+                files_deleted += 1
+            else:
+                dir_size += file[2]
+                dir_files += 1
+        else:
+            dir_size += file[2]
+            dir_files += 1
+
+    for i in subdirs:
+        subdir = current_dir / Path(repo[i]['directory'])
+        keep = int(repo[i]['keep'])
+        sorted_file_list = sorted(((file.stat().st_mtime, file, file.stat().st_size) for file in subdir.glob(repo['pattern']) if file.is_file()), reverse=True)
+        for file_num, file in enumerate(sorted_file_list):
+            if file_num < keep:
+                dir_size += file[2]
+                dir_files += 1
+            elif move_old_path:
+                destination = move_old_path / Path(file[1].name)
+                if not destination.exists():
+                    shutil.move(file[1], destination)
+            elif 'delete_old' in repo.keys() and repo['delete_old']:
+                file[1].unlink()
+                files_deleted += 1
+            else:
+                dir_size += file[2]
+                dir_files += 1
+    return dir_files, dir_size, files_deleted
+
+
+def generate_repo(root, rng, subdirs, move_old):
+    files = [("b{:03d}.bck".format(n), rng.uniform(0, 1200), rng.randrange(1, 100)) for n in range(rng.randrange(40))]
+    files.append(("other.txt", 5, 10))
+    create_files(root / "base", files)
+    repo = {'directory': str(root / "base"), 'pattern': "*.bck", 'keep': rng.randrange(1, 10), 'delete_old': rng.random() < 0.7}
+    for period in subdirs:
+        repo[period] = {'directory': "../" + period, 'keep': rng.randrange(1, 6)}
+        create_files(root / period, [("{}{}.bck".format(period, n), rng.uniform(0, 1200), 5) for n in range(rng.randrange(4))])
+    if move_old:
+        repo['move_old_to'] = "../archive"
+        create_files(root / "archive", [])
+    if rng.random() < 0.3:
+        repo['rename_moved_files'] = "mv-{}"
+    return repo
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_retention_matches_baseline(tmp_path, seed):
+    rng = random.Random(seed)
+    subdirs = [period for period in ('weekly', 'monthly', 'yearly') if rng.random() < 0.6]
+    move_old = rng.random() < 0.5
+    repo = generate_repo(tmp_path / "baseline", random.Random(seed), subdirs, move_old)
+    expected = baseline_cleanup(repo)
+    repo = generate_repo(tmp_path / "planned", random.Random(seed), subdirs, move_old)
+    result = bck_mgmt.process_repo(repo)
+    assert (result['files'], result['size'], result['deleted']) == expected
+    assert tree(tmp_path / "planned") == tree(tmp_path / "baseline")
+
+
+def test_plan_retention_buckets(tmp_path):
+    # one file per week of 2024 and 2025 (the newest is the newest file), the 4 newest are kept in the base directory
+    create_files(tmp_path / "base", [("w{:03d}.bck".format(n), n * 7, 1) for n in range(60)])
+    for period in ('weekly', 'monthly', 'yearly'):
+        (tmp_path / period).mkdir()
+    create_files(tmp_path / "yearly", [("old.bck", 400, 1)])
+    repo = {'directory': str(tmp_path / "base"), 'pattern': "*.bck", 'keep': 4, 'delete_old': True,
+        'weekly': {'directory': "../weekly", 'keep': 3}, 'monthly': {'directory': "../monthly", 'keep': 100}, 'yearly': {'directory': "../yearly", 'keep': 100}}
+    subdir_paths = dict((period, tmp_path / period) for period in ('weekly', 'monthly', 'yearly'))
+    subdir_files = dict((path, scan(path)) for path in subdir_paths.values())
+    actions, kept_files, kept_size = bck_mgmt.plan_retention(repo, scan(tmp_path / "base"), subdir_paths, None, subdir_files, bck_mgmt.compile_pattern("*.bck"))
+    moves = [action for action in actions if action['action'] == 'move']
+    deleted = [action for action in actions if action['action'] == 'delete']
+    # the oldest file of 2025 goes to the yearly directory (2024 already has a file there), the oldest file of each month
+    # to the monthly directory and the oldest file of each other week to the weekly directory:
+    assert [action['file'].name for action in moves if action['destination'].parent.name == 'yearly'] == ["w023.bck"]
+    months = set(datetime.date.fromtimestamp(action['mtime']).strftime("%Y-%m") for action in moves if action['destination'].parent.name == 'monthly')
+    assert len(months) == len([action for action in moves if action['destination'].parent.name == 'monthly'])
+    weekly = [action for action in moves if action['destination'].parent.name == 'weekly']
+    assert len(moves) == 56
+    # the files moved into the weekly directory take part in its clean up, only the 3 newest are kept:
+    weekly_actions = [(action['action'], action['file'].name) for action in actions if action['subdir'] == 'weekly']
+    newest_first = [action['destination'].name for action in reversed(weekly)]
+    assert weekly_actions == [('keep', name) for name in newest_first[:3]] + [('delete', name) for name in newest_first[3:]]
+    assert deleted == [action for action in actions if action['subdir'] == 'weekly' and action['action'] == 'delete']
+    # files moved in the same run have an action, only the 4 newest files of the base directory and the old yearly file are counted:
+    assert (kept_files, kept_size) == (5, 5)
+    # nothing was changed on the file system:
+    assert len(list((tmp_path / "base").iterdir())) == 60
+
+
+def test_plan_retention_conflict(tmp_path):
+    create_files(tmp_path / "base", [("a.bck", 10, 1), ("b.bck", 1, 1)])
+    create_files(tmp_path / "archive", [("a.bck", 100, 1)])
+    repo = {'directory': str(tmp_path / "base"), 'pattern': "*.bck", 'keep': 1}
+    actions, kept_files, kept_size = bck_mgmt.plan_retention(repo, scan(tmp_path / "base"), {}, tmp_path / "archive", {}, bck_mgmt.compile_pattern("*.bck"))
+    assert [(action['action'], action['file'].name) for action in actions] == [('conflict', "a.bck")]
+    assert (kept_files, kept_size) == (1, 1)
+
+
+def test_execute_plan_keeps_files_written_during_the_batch(tmp_path, monkeypatch):
+    create_files(tmp_path / "base", [("b{}.bck".format(n), n, 1) for n in range(5)])
+    create_files(tmp_path / "archive", [])
+    os.utime(tmp_path / "base", (NOW - DAY, NOW - DAY))
+    (tmp_path / "state").mkdir()
+    index = bck_mgmt.ScanIndex(bck_mgmt.open_state_db(tmp_path / "state"))
+    segments = bck_mgmt.compile_pattern("*.bck")
+    table = index.scan_directory(tmp_path / "base", "*.bck", segments)
+    repo = {'directory': str(tmp_path / "base"), 'pattern': "*.bck", 'keep': 2, 'delete_old': True}
+    actions, kept_files, kept_size = bck_mgmt.plan_retention(repo, table, {}, tmp_path / "archive", {}, segments)
+    rename = os.rename
+
+    def slow_rename(source, destination):
+        # another process writes a new backup file while the files are moved:
+        rename(source, destination)
+        if not (tmp_path / "base" / "new.bck").exists():
+            (tmp_path / "base" / "new.bck").write_bytes(b"x")
+
+    monkeypatch.setattr(bck_mgmt.os, "rename", slow_rename)
+    assert bck_mgmt.execute_plan(actions, "test", index) == 0
+    monkeypatch.undo()
+    table = index.scan_directory(tmp_path / "base", "*.bck", segments)
+    assert sorted(table.name(row) for row in table.order) == ["b0.bck", "b1.bck", "new.bck"]
+    assert sorted(path.name for path in (tmp_path / "archive").iterdir()) == ["b2.bck", "b3.bck", "b4.bck"]
@@ -0,0 +1,90 @@
+import os
+from pathlib import Path
+
+import pytest
+
+import bck_mgmt_core as bck_mgmt
+
+PATTERNS = ["*.bck", "*", "**/*.bck", "**/Test2*.bck", "sub*/*.bck", "sub1/**/*.bck", "**/deep/*.bck", "*/*/*.bck", "**"]
+
+
+@pytest.fixture
+def repo(tmp_path):
+    files = ["a.bck", "b.bck", "c.txt", "Test2-1.bck", "sub1/d.bck", "sub1/Test2-2.bck", "sub1/deep/e.bck",
+        "sub1/deep/deeper/f.bck", "sub2/g.bck", "sub2/deep/h.bck", "other/deep/i.txt", bck_mgmt.INTERNAL_PREFIX + ".lock",
+        "sub1/" + bck_mgmt.INTERNAL_PREFIX + "-x.bck.tmp"]
+    for num, name in enumerate(files):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * num)
+        # some files share their mtime, they are sorted by path:
+        os.utime(path, (1000000 + num // 2, 1000000 + num // 2))
+    (tmp_path / "dir.bck").mkdir()
+    (tmp_path / "link").symlink_to(tmp_path / "sub1")
+    (tmp_path / "broken.bck").symlink_to(tmp_path / "missing")
+    return tmp_path
+
+
+def glob_files(directory, pattern):
+    # the files returned by the glob based scanner this scanner replaced
+    return sorted((path.stat().st_mtime, path, path.stat().st_size) for path in Path(directory).glob(pattern)
+        if path.is_file() and not path.name.startswith(bck_mgmt.INTERNAL_PREFIX))
+
+
+def table_files(table):
+    return [(table.mtimes[row], table.path(row), table.sizes[row]) for row in table.order]
+
+
+@pytest.mark.parametrize("pattern", PATTERNS)
+def test_scan_directory_matches_glob(repo, pattern):
+    table = bck_mgmt.scan_directory(repo, bck_mgmt.compile_pattern(pattern))
+    assert table_files(table) == glob_files(repo, pattern)
+
+
+@pytest.mark.parametrize("pattern", PATTERNS)
+def test_scan_newest(repo, pattern):
+    expected = glob_files(repo, pattern)
+    table, files, size = bck_mgmt.scan_newest(repo, bck_mgmt.compile_pattern(pattern))
+    assert table_files(table) == expected[-2:]
+    assert (files, size) == (len(expected), sum(size for mtime, path, size in expected))
+
+
+def test_compressed_extensions(repo):
+    (repo / "old.bck.gz").write_bytes(b"")
+    (repo / "old.bck.xz").write_bytes(b"")
+    table = bck_mgmt.scan_directory(repo, bck_mgmt.compile_pattern("*.bck", (".gz",)))
+    names = set(table.name(row) for row in table.order)
+    assert "old.bck.gz" in names and "old.bck.xz" not in names
+
+
+def test_match_name():
+    assert bck_mgmt.match_name(bck_mgmt.compile_pattern("*.bck"), "a.bck")
+    assert bck_mgmt.match_name(bck_mgmt.compile_pattern("**/*.bck"), "a.bck")
+    assert not bck_mgmt.match_name(bck_mgmt.compile_pattern("sub/*.bck"), "a.bck")
+    assert not bck_mgmt.match_name(bck_mgmt.compile_pattern("*.bck"), "a.bck.gz")
+
+
+def test_scan_index_rescans_directories_changed_during_a_batch(tmp_path):
+    directory = tmp_path / "repo"
+    directory.mkdir()
+    for name in ("f1.bck", "f2.bck", "f3.bck"):
+        (directory / name).write_bytes(b"x")
+    os.utime(directory, (1000000, 1000000))
+    (tmp_path / "state").mkdir()
+    index = bck_mgmt.ScanIndex(bck_mgmt.open_state_db(tmp_path / "state"))
+    segments = bck_mgmt.compile_pattern("*.bck")
+
+    def names():
+        table = index.scan_directory(directory, "*.bck", segments)
+        return sorted(table.name(row) for row in table.order)
+
+    assert names() == ["f1.bck", "f2.bck", "f3.bck"]
+
+    def execute():
+        (directory / "f3.bck").unlink()
+        # written by another process while the batch is executed:
+        (directory / "external.bck").write_bytes(b"x")
+        return [(directory / "f3.bck", None)]
+
+    index.update_batch([(directory / "f3.bck", None)], execute)
+    assert names() == ["external.bck", "f1.bck", "f2.bck"]
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import bck_mgmt_core as bck_mgmt
+
+
+def repositories(count):
+    return [{'directory': "/data/backups/repo{}".format(num), 'alias': "repo {}".format(num)} for num in range(count)]
+
+
+def aliases(repos):
+    return [repo['alias'] for repo in repos]
+
+
+@pytest.mark.parametrize("shards", [1, 2, 3, 7])
+def test_shards_cover_all_repositories_once(shards):
+    repos = repositories(50)
+    selected = [aliases(bck_mgmt.shard_repositories(repos, shard, shards)) for shard in range(1, shards + 1)]
+    assert sorted(alias for shard in selected for alias in shard) == sorted(aliases(repos))
+    # each shard keeps the config order:
+    assert all(shard == [alias for alias in aliases(repos) if alias in shard] for shard in selected)
+    # with 50 repositories every shard gets some:
+    assert all(selected)
+
+
+def test_shard_by_alias_is_stable():
+    repos = repositories(50)
+    before = dict((shard, aliases(bck_mgmt.shard_repositories(repos, shard, 3))) for shard in (1, 2, 3))
+    # the assignment doesn't depend on the other repositories or their order:
+    changed = list(reversed(repos[:20])) + repositories(60)[50:] + repos[20:]
+    after = dict((shard, aliases(bck_mgmt.shard_repositories(changed, shard, 3))) for shard in (1, 2, 3))
+    for shard in (1, 2, 3):
+        assert set(before[shard]) <= set(after[shard])
+    # repositories without alias are assigned by their directory:
+    assert bck_mgmt.shard_repositories([{'directory': "/data/backups/repo0"}], 1, 1) == [{'directory': "/data/backups/repo0"}]
+
+
+def test_shard_by_duration_balances_load():
+    repos = repositories(6)
+    durations = dict(((repo['alias'], repo['directory']), duration) for repo, duration in zip(repos, [100, 60, 50, 40, 30, 20]))
+    selected = [aliases(bck_mgmt.shard_repositories(repos, shard, 2, durations)) for shard in (1, 2)]
+    # longest first to the shard with the lowest total: 100 | 60 50 | 100 40 | 60 50 30 | 100 40 20
+    assert selected == [["repo 0", "repo 3", "repo 5"], ["repo 1", "repo 2", "repo 4"]]
+    # a repository without a duration counts as average (50), ties are sorted by alias: 100 | 60 50(new) | 100 50 | 60 50 40 | 100 50 30 | 60 50 40 20
+    repos.append({'directory': "/data/backups/new", 'alias': "new"})
+    selected = [aliases(bck_mgmt.shard_repositories(repos, shard, 2, durations)) for shard in (1, 2)]
+    assert selected == [["repo 0", "repo 2", "repo 4"], ["repo 1", "repo 3", "repo 5", "new"]]
+
+
+def test_load_durations(tmp_path):
+    metrics_file = tmp_path / "metrics.json"
+    metrics_file.write_text(json.dumps({'repositories': [
+        {'alias': "a", 'directory': "/data/a", 'metrics': {'scan_ms': 10, 'retention_ms': 5, 'syscalls': 100}},
+        {'alias': "b", 'directory': "/data/b", 'metrics': {'syscalls': 0}}, # skipped in the last run
+    ]}))
+    assert bck_mgmt.load_durations(str(metrics_file)) == {("a", "/data/a"): 15}
+    assert bck_mgmt.load_durations(str(tmp_path / "missing.json")) == {}
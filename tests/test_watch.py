@@ -0,0 +1,51 @@
+import sys
+import time
+
+import pytest
+
+import bck_mgmt_core as bck_mgmt
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason="watch mode is Linux only")
+
+
+def watch(tmp_path, monkeypatch, after_scan, before_scan=lambda: None):
+    # Runs watch mode with two repositories until the second run and returns the aliases of the repositories of each run.
+    # The callbacks create files before and after the first scan started (file times are only precise to a clock tick).
+    backup_repo = []
+    for alias in ("a", "b"):
+        (tmp_path / alias).mkdir()
+        backup_repo.append({'directory': str(tmp_path / alias), 'alias': alias, 'pattern': "*.bck"})
+    runs = []
+
+    def run(repos, pulling=None):
+        runs.append([repo['alias'] for repo in repos])
+        if len(runs) > 1:
+            raise KeyboardInterrupt
+        before_scan()
+        time.sleep(0.05)
+        scan_time = time.time()
+        time.sleep(0.05)
+        after_scan()
+        return [{'exitcode': 0, 'newest_mtime': None, 'scan_time': scan_time} for repo in repos]
+
+    monkeypatch.setattr(bck_mgmt, 'report', lambda parsed_config, backup_repo, results: 0)
+    monkeypatch.setattr(bck_mgmt.signal, 'signal', lambda signum, handler: None)
+    assert bck_mgmt.watch({'watch': {'settle_time': 0}}, backup_repo, run) == 0
+    return runs
+
+
+def test_new_file_is_processed(tmp_path, monkeypatch):
+    def after_scan():
+        (tmp_path / "b" / "new.bck").write_bytes(b"x")
+        (tmp_path / "a" / "other.txt").write_bytes(b"x") # doesn't match the pattern
+        (tmp_path / "a" / (bck_mgmt.INTERNAL_PREFIX + ".lock")).write_bytes(b"x")
+    assert watch(tmp_path, monkeypatch, after_scan) == [["a", "b"], ["b"]]
+
+
+def test_files_written_before_the_scan_are_not_processed_again(tmp_path, monkeypatch):
+    # e.g. written by the pull command of the repository, so they were already processed by the run:
+    def before_scan():
+        (tmp_path / "a" / "pulled.bck").write_bytes(b"x")
+    def after_scan():
+        (tmp_path / "b" / "new.bck").write_bytes(b"x")
+    assert watch(tmp_path, monkeypatch, after_scan, before_scan) == [["a", "b"], ["b"]]